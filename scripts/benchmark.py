@@ -0,0 +1,623 @@
+from argparse import ArgumentParser, Namespace, SUPPRESS
+from collections import Counter
+from hashlib import sha256
+from json import dumps, load
+from os import environ
+from pathlib import Path
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from runpy import run_path
+from subprocess import run as run_process
+from tempfile import TemporaryDirectory
+from time import monotonic, perf_counter, sleep as sleep_sync
+from typing import Optional
+import sys
+
+import anyio
+from httpx import AsyncBaseTransport, Request, Response, URL
+from pydantic import BaseModel
+from requests import PreparedRequest, Response as RequestsResponse
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+SCRIPTS_DIR: Path = Path(__file__).parent
+SITE_DATA_DIR: Path = SCRIPTS_DIR.parent / "src" / "data"
+
+FETCHERS: dict[str, str] = {
+    "events": "planningcenter_fetch_events.py",
+    "ministries": "planningcenter_fetch_ministries.py",
+    "sermons": "sermonaudio_fetch.py",
+}
+
+PLANNINGCENTER_HOST: str = "api.planningcenteronline.com"
+SERMONAUDIO_HOST: str = "api.sermonaudio.com"
+IMAGES_HOST: str = "images.benchmark.test"
+
+MINISTRY_TAGS: list[str] = [
+    "Children's Ministry",
+    "Counseling",
+    "Home Groups",
+    "Men's Ministry",
+    "Prime Timers (Seniors Ministry)",
+    "Vacation Bible School",
+    "Women's Ministry",
+    "Rooted (Youth Ministry)",
+]
+
+MINISTRY_PAGES: list[str] = [
+    "childrens-ministry",
+    "counseling-ministry",
+    "home-groups-ministry",
+    "mens-ministry",
+    "senior-adults-ministry",
+    "vbs-ministry",
+    "womens-ministry",
+    "youth-group",
+]
+
+
+class FakeConfig(BaseModel):
+    size: int
+    latency: float
+    error_rate: float
+    retry_after: int
+    rate_limit: int
+    rate_period: int
+    instances_per_event: int
+    image_size: int
+    seed: int
+
+
+class Scenario(BaseModel):
+    fetcher: str
+    run: int
+    work_dir: str
+    result_file: str
+    config: FakeConfig
+
+
+class RunResult(BaseModel):
+    fetcher: str
+    size: int
+    run: int
+    wall_time: float
+    api_calls: int
+    image_calls: int
+    not_modified: int
+    rate_limited: int
+    throttled_seconds: float
+    bytes_served: int
+    bytes_written: int
+    peak_rss_mb: float
+
+
+class FakeAPI:
+    """
+    Serves generated Planning Center, SermonAudio and image responses sized by the config. The responses follow
+    the shapes the fetchers validate, the checked in fixtures and site data are used as templates where they exist.
+    """
+
+    def __init__(self, config: FakeConfig):
+        self.config: FakeConfig = config
+        self.random: Random = Random(config.seed)
+        self.calls: Counter = Counter()
+        self.window_start: float = monotonic()
+        self.window_count: int = 0
+
+        self.tag_groups: dict = load((SCRIPTS_DIR / "group_tag_groups.json").open())
+        self.group_tags: dict = load((SCRIPTS_DIR / "group_tags.json").open())
+        self.sermon: Optional[dict] = None
+
+    def handle(self, method: str, url: URL, headers: dict[str, str]) -> tuple[int, dict[str, str], bytes]:
+        if url.host == IMAGES_HOST:
+            self.calls["images"] += 1
+            return self.image(url, headers)
+
+        self.calls["api"] += 1
+        body: Optional[dict] = None
+        response_headers: dict[str, str] = {}
+
+        if url.host == PLANNINGCENTER_HOST:
+            # only planning center rate limits, the sermonaudio SDK does not retry
+            if self.random.random() < self.config.error_rate:
+                self.calls["429"] += 1
+                return 429, {"Retry-After": str(self.config.retry_after), **self.rate_headers()}, b'{"errors": [{"status": "429"}]}'
+
+            body = self.planningcenter(url)
+            response_headers = self.rate_headers()
+
+        elif url.host == SERMONAUDIO_HOST:
+            body = self.sermonaudio(url)
+
+        if body is None:
+            return 404, {"content-type": "application/json"}, b'{"errors": [{"status": "404"}]}'
+
+        content: bytes = dumps(body).encode()
+        self.calls["bytes"] += len(content)
+        return 200, {"content-type": "application/json", **response_headers}, content
+
+    def rate_headers(self) -> dict[str, str]:
+        now: float = monotonic()
+        if now - self.window_start >= self.config.rate_period:
+            self.window_start = now
+            self.window_count = 0
+
+        self.window_count += 1
+        return {
+            "X-PCO-API-Request-Rate-Limit": str(self.config.rate_limit),
+            "X-PCO-API-Request-Rate-Period": str(self.config.rate_period),
+            "X-PCO-API-Request-Rate-Count": str(self.window_count),
+        }
+
+    def image(self, url: URL, headers: dict[str, str]) -> tuple[int, dict[str, str], bytes]:
+        etag: str = f'"{sha256(str(url).encode()).hexdigest()[:16]}"'
+        if headers.get("if-none-match") == etag:
+            self.calls["304"] += 1
+            return 304, {"etag": etag}, b""
+
+        content_type: str = "image/png" if url.path.endswith(".png") else "image/jpeg"
+        content: bytes = (url.path.encode() * (self.config.image_size // len(url.path) + 1))[: self.config.image_size]
+        self.calls["bytes"] += len(content)
+        return 200, {"content-type": content_type, "etag": etag}, content
+
+    def planningcenter(self, url: URL) -> Optional[dict]:
+        parts: list[str] = url.path.strip("/").split("/")
+        offset: int = int(url.params.get("offset", 0))
+        per_page: int = int(url.params.get("per_page", 100))
+
+        match parts:
+            case ["calendar", "v2", "calendar_instances"]:
+                return self.calendar_instances(offset, per_page)
+            case ["calendar", "v2", "events"]:
+                return self.events(offset, per_page)
+            case ["calendar", "v2", "events", event_id, "event_connections"]:
+                return self.event_connections(int(event_id))
+            case ["groups", "v2", "tag_groups"]:
+                return self.tag_groups
+            case ["groups", "v2", "groups"]:
+                return self.groups(offset, per_page)
+            case ["groups", "v2", "groups", _, "tags"]:
+                return self.group_tags
+            case ["registrations", "v2", "events", event_id]:
+                return {"data": self.registration_event(event_id)}
+            case ["publishing", "v2", "pages"]:
+                return self.pages(offset, per_page)
+
+        return None
+
+    def paged(self, data: list[dict], total: int, included: Optional[list[dict]] = None) -> dict:
+        return {"data": data, "included": included or [], "meta": {"count": len(data), "total_count": total}}
+
+    def calendar_instances(self, offset: int, per_page: int) -> dict:
+        data: list[dict] = []
+        included: dict[tuple[str, str], dict] = {}
+
+        for i in range(offset, min(offset + per_page, self.config.size)):
+            # the calendar is ordered by start time so the instances of recurring events are interleaved
+            event_id: int = 1000 + i % self.event_count()
+            tag_id: int = event_id % len(MINISTRY_TAGS)
+            data.append(
+                {
+                    "type": "CalendarInstance",
+                    "id": str(i),
+                    "attributes": {
+                        "all_day_event": False,
+                        "ends_at": "2025-01-05T18:00:00Z",
+                        "event_featured": event_id % 10 == 0,
+                        "event_name": f"Event {event_id}",
+                        "starts_at": "2025-01-05T17:00:00Z",
+                        "status": "confirmed",
+                        "visible_ends_at": "2025-01-05T18:00:00Z",
+                        "visible_starts_at": "2025-01-05T17:00:00Z",
+                    },
+                    "relationships": {
+                        "event": {"data": {"type": "Event", "id": str(event_id)}},
+                        "tags": {"data": [{"type": "Tag", "id": str(tag_id)}]},
+                    },
+                }
+            )
+            included[("Event", str(event_id))] = self.event(event_id)
+            included[("Tag", str(tag_id))] = {
+                "type": "Tag",
+                "id": str(tag_id),
+                "attributes": {"name": MINISTRY_TAGS[tag_id], "color": "#6ADCC8"},
+                "relationships": {"tag_group": {"data": {"type": "TagGroup", "id": "1"}}},
+            }
+
+        included[("TagGroup", "1")] = {"type": "TagGroup", "id": "1", "attributes": {"name": "Ministry", "required": False}}
+        return self.paged(data, self.config.size, list(included.values()))
+
+    def event(self, event_id: int) -> dict:
+        return {
+            "type": "Event",
+            "id": str(event_id),
+            "attributes": {
+                "approval_status": "A",
+                "created_at": "2024-12-01T00:00:00Z",
+                "description": f"<p>Description of event {event_id}</p>" * 5,
+                "featured": event_id % 10 == 0,
+                "image_url": f"https://{IMAGES_HOST}/events/{event_id}.png?key=k{event_id}",
+                "name": f"Event {event_id}",
+                "percent_approved": 100,
+                "percent_rejected": 0,
+                "registration_url": None,
+                "summary": f"Summary of event {event_id}",
+                "updated_at": "2025-01-01T00:00:00Z",
+                "visible_in_church_center": True,
+            },
+        }
+
+    def events(self, offset: int, per_page: int) -> dict:
+        # every event with its connections included, the way the events listing includes them
+        data: list[dict] = []
+        included: list[dict] = []
+
+        for event_id in range(1000 + offset, 1000 + min(offset + per_page, self.event_count())):
+            connections: list[dict] = self.event_connections(event_id)["data"]
+            event: dict = self.event(event_id)
+            event["relationships"] = {"event_connections": {"data": [{"type": c["type"], "id": c["id"]} for c in connections]}}
+            data.append(event)
+            included.extend(connections)
+
+        return self.paged(data, self.event_count(), included)
+
+    def groups(self, offset: int, per_page: int) -> dict:
+        # the groups the events are connected to with their tags included
+        group_ids: list[int] = [event_id for event_id in range(1000, 1000 + self.event_count()) if event_id % 3 == 0]
+        tags: list[dict] = self.group_tags["data"]
+        data: list[dict] = [
+            {
+                "type": "Group",
+                "id": str(group_id),
+                "attributes": {"name": f"Group {group_id}"},
+                "relationships": {"tags": {"data": [{"type": t["type"], "id": t["id"]} for t in tags]}},
+            }
+            for group_id in group_ids[offset : offset + per_page]
+        ]
+
+        return self.paged(data, len(group_ids), tags)
+
+    def event_count(self) -> int:
+        return max(self.config.size // self.config.instances_per_event, 1)
+
+    def event_connections(self, event_id: int) -> dict:
+        data: list[dict] = []
+
+        # a third of the events are connected to a group and a fifth to a signup
+        if event_id % 3 == 0:
+            data.append(self.connection(event_id, "group", "groups"))
+        if event_id % 5 == 0:
+            data.append(self.connection(event_id, "signup", "registrations"))
+
+        return self.paged(data, len(data))
+
+    def connection(self, event_id: int, connected_to_type: str, product_name: str) -> dict:
+        return {
+            "type": "EventConnection",
+            "id": f"{event_id}-{connected_to_type}",
+            "attributes": {
+                "connected_to_id": event_id,
+                "connected_to_name": f"{connected_to_type.title()} {event_id}",
+                "connected_to_type": connected_to_type,
+                "connected_to_url": f"https://{product_name}.planningcenteronline.com/{event_id}",
+                "product_name": product_name,
+            },
+        }
+
+    def registration_event(self, event_id: str) -> dict:
+        return {
+            "type": "Event",
+            "id": event_id,
+            "attributes": {
+                "at_maximum_capacity": False,
+                "visibility": "public",
+                "closed": False,
+                "open": True,
+                "open_at": "2025-01-01T00:00:00Z",
+                "hide_at": None,
+                "show_at": "2024-12-01T08:00:00Z",
+            },
+        }
+
+    def pages(self, offset: int, per_page: int) -> dict:
+        # the ministry pages come first followed by pages the fetcher skips to fill the listing out to the size
+        total: int = max(self.config.size, len(MINISTRY_PAGES))
+        return self.paged([self.page(i) for i in range(offset, min(offset + per_page, total))], total)
+
+    def page(self, i: int) -> dict:
+        slug: str = MINISTRY_PAGES[i] if i < len(MINISTRY_PAGES) else f"page-{i}"
+        image: str = f"https://{IMAGES_HOST}/pages/{slug}"
+        text: str = "".join(f'<h2>Heading {n}</h2><p>Paragraph {n} of {slug} with <a href="https://example.com/{n}">a link</a>.</p>' for n in range(20))
+
+        blocks: list[dict] = [
+            {
+                "type": "SectionHeader",
+                "id": f"{i}-header",
+                "attributes": {
+                    "background_image_enabled": True,
+                    "callout_button_enabled": False,
+                    "callout_button_text": "",
+                    "callout_link_url": "",
+                    "callout_position": "center",
+                    "callout_text": slug.replace("-", " ").title(),
+                    "callout_text_alignment": "center",
+                    "callout_text_color": "#fff",
+                    "callout_text_enabled": True,
+                    "height": "medium",
+                    "mobile_full_bleed_enabled": False,
+                    "background_image_url": f"{image}/header.jpg",
+                },
+            },
+            {"type": "Text", "id": f"{i}-text", "attributes": {"content": text, "text_align": "left"}},
+            {"type": "Divider", "id": f"{i}-divider", "attributes": {}},
+            {
+                "type": "Image",
+                "id": f"{i}-image",
+                "attributes": {
+                    "link_target": "_self",
+                    "link_url": "",
+                    "link_url_enabled": False,
+                    "alt": "photo.jpg",
+                    "src": f"{image}/photo.jpg",
+                    "srcset": "",
+                    "sizes": "",
+                },
+            },
+            {
+                "type": "Grid",
+                "id": f"{i}-grid",
+                "attributes": {
+                    "items": [
+                        {
+                            "body": f"Item {n}",
+                            "button_text": "",
+                            "title": f"Title {n}",
+                            "position": None,
+                            "link_target": "_self",
+                            "link_url": f"https://example.com/{n}",
+                            "alt": "",
+                            "src": f"{image}/grid-{n}.jpg",
+                            "srcset": "",
+                            "sizes": "",
+                        }
+                        for n in range(3)
+                    ],
+                    "image_enabled": True,
+                    "image_constraint_enabled": False,
+                    "image_scale_up_enabled": False,
+                    "title_enabled": True,
+                    "body_enabled": True,
+                    "button_enabled": False,
+                    "columns_desktop": 3,
+                    "columns_mobile": 1,
+                    "items_position": "center",
+                    "button_size": "md",
+                    "button_style": "primary",
+                    "button_position": "center",
+                },
+            },
+        ]
+
+        return {"type": "Page", "id": str(i), "attributes": {"blocks": blocks, "content": "", "slug": slug, "title": slug.replace("-", " ").title()}}
+
+    def sermonaudio(self, url: URL) -> Optional[dict]:
+        page: int = int(url.params.get("page", 1))
+        page_size: int = int(url.params.get("pageSize", 100))
+
+        if url.path.endswith("/sermons"):
+            return self.node("sermons", [self.sermon_result(i) for i in range(self.config.size)], page, page_size)
+        if url.path.endswith("/series"):
+            return self.node("series", self.site_results("series", "seriesID"), page, page_size)
+        if url.path.endswith("/speakers"):
+            return self.node("speakers", self.site_results("speakers", "speakerID"), page, page_size)
+
+        return None
+
+    def node(self, node_type: str, results: list[dict], page: int, page_size: int) -> dict:
+        return {
+            "nodeType": node_type,
+            "nodeDisplayName": node_type,
+            "results": results[(page - 1) * page_size : page * page_size],
+            "totalCount": len(results),
+            "next": None,
+        }
+
+    def site_results(self, collection: str, id_key: str) -> list[dict]:
+        results: list[dict] = []
+        for data_file in sorted((SITE_DATA_DIR / collection).glob("*.json")):
+            data: dict = load(data_file.open())
+            data[id_key] = data.pop("id")
+            results.append(data)
+
+        return results
+
+    def sermon_result(self, i: int) -> dict:
+        # the site data is stored in the shape of our models so map it back to the shape the api sends
+        if self.sermon is None:
+            self.sermon = load(min((SITE_DATA_DIR / "sermons").glob("*.json")).open())
+            self.sermon["sermonID"] = self.sermon.pop("id")
+            self.sermon["speaker"]["speakerID"] = self.sermon["speaker"].pop("id")
+            self.sermon["series"]["seriesID"] = self.sermon["series"].pop("id")
+            self.sermon["broadcaster"]["broadcasterID"] = self.sermon["broadcaster"].pop("id")
+            for kind, media in self.sermon["media"].items():
+                if isinstance(media, list):
+                    self.sermon["media"][kind] = [{"bitrate": None, **m} for m in media]
+
+        sermon_id: str = str(200000000000000 + i)
+        video: dict = {**self.sermon["media"]["video"][0], "thumbnailImageURL": f"https://{IMAGES_HOST}/thumbnails/{sermon_id}.jpg"}
+        return {
+            **self.sermon,
+            "sermonID": sermon_id,
+            "fullTitle": f"Sermon {i}",
+            "displayTitle": f"Sermon {i}",
+            "publishTimestamp": self.sermon["publishTimestamp"] - i * 3600,
+            "media": {**self.sermon["media"], "video": [video]},
+        }
+
+
+class FakeTransport(AsyncBaseTransport):
+    def __init__(self, api: FakeAPI):
+        self.api: FakeAPI = api
+
+    async def handle_async_request(self, request: Request) -> Response:
+        await anyio.sleep(self.api.config.latency)
+        status_code, headers, body = self.api.handle(request.method, request.url, dict(request.headers))
+        return Response(status_code, headers=headers, content=body, request=request)
+
+
+class FakeAdapter(HTTPAdapter):
+    def __init__(self, api: FakeAPI):
+        super().__init__()
+        self.api: FakeAPI = api
+
+    def send(self, request: PreparedRequest, **kwargs) -> RequestsResponse:
+        sleep_sync(self.api.config.latency)
+        status_code, headers, body = self.api.handle(request.method, URL(request.url), {k.lower(): v for k, v in request.headers.items()})
+
+        response: RequestsResponse = RequestsResponse()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = "utf-8"
+        response._content = body
+        response.url = request.url
+        response.request = request
+        return response
+
+
+def bytes_written() -> int:
+    # characters written by the process, linux only
+    io_file: Path = Path("/proc/self/io")
+    if not io_file.exists():
+        return 0
+
+    return next(int(line.split()[1]) for line in io_file.read_text().splitlines() if line.startswith("wchar:"))
+
+
+def run_scenario(scenario: Scenario) -> None:
+    """
+    Run one fetcher in this process against the fake api and write its result. Every scenario gets a fresh
+    process so the peak RSS of one run does not carry over into the next.
+    """
+    api: FakeAPI = FakeAPI(scenario.config)
+
+    # route the pooled client and the sermonaudio SDK session to the fake api
+    import http_client
+    import sermonaudio
+    from sermonaudio import models
+    from sermonaudio.models import override_model, Model
+
+    class RawResult(Model): ...
+
+    http_client.AsyncHTTPTransport = lambda **kwargs: FakeTransport(api)
+    sermonaudio._session.mount("https://", FakeAdapter(api))
+
+    # the site data the sermon results are generated from lacks fields the SDK models assert on, the fetcher only
+    # reads the raw result so keep that instead of the parsed model
+    for model in (models.Sermon, models.SermonSeries, models.Speaker):
+        override_model(model)(RawResult)
+
+    environ.update(PLANNINGCENTER_CLIENT_ID="benchmark", PLANNINGCENTER_SECRET="benchmark", SERMONAUDIO_API_KEY="benchmark")
+    work_dir: Path = Path(scenario.work_dir)
+    metrics_file: Path = work_dir / "metrics.json"
+    sys.argv = [FETCHERS[scenario.fetcher], "--data-dir", str(work_dir / "data"), "--metrics-file", str(metrics_file)]
+    if scenario.fetcher != "sermons":
+        sys.argv += ["--assets-dir", str(work_dir / "assets")]
+
+    written: int = bytes_written()
+    start: float = perf_counter()
+    run_path(str(SCRIPTS_DIR / FETCHERS[scenario.fetcher]), run_name="__main__")
+    wall_time: float = perf_counter() - start
+
+    result: RunResult = RunResult(
+        fetcher=scenario.fetcher,
+        size=scenario.config.size,
+        run=scenario.run,
+        wall_time=wall_time,
+        api_calls=api.calls["api"],
+        image_calls=api.calls["images"],
+        not_modified=api.calls["304"],
+        rate_limited=api.calls["429"],
+        throttled_seconds=load(metrics_file.open())["throttled_seconds"],
+        bytes_served=api.calls["bytes"],
+        bytes_written=bytes_written() - written,
+        peak_rss_mb=getrusage(RUSAGE_SELF).ru_maxrss / 1024,
+    )
+    Path(scenario.result_file).write_text(result.model_dump_json())
+
+
+def parse_args():
+    """
+    Parse the command line arguments using the argparse library.
+
+    Returns:
+        Namespace: A Namespace object containing the parsed arguments.
+    """
+
+    parser = ArgumentParser(description="benchmark the fetchers against a fake planning center and sermonaudio api")
+    parser.add_argument("--fetchers", nargs="+", choices=list(FETCHERS), default=list(FETCHERS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=[400], help="calendar instances, publishing pages or sermons served")
+    parser.add_argument("--runs", type=int, default=2, help="runs per size sharing the data dir, the first starts empty")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of planning center requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry after seconds sent with the 429s")
+    parser.add_argument("--rate-limit", type=int, default=1000, help="requests per period advertised in the rate limit headers")
+    parser.add_argument("--rate-period", type=int, default=20)
+    parser.add_argument("--instances-per-event", type=int, default=10)
+    parser.add_argument("--image-size", type=int, default=50_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, help="write the results to this json file")
+    parser.add_argument("--scenario", type=str, help=SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args: Namespace = parse_args()
+
+    if args.scenario:
+        run_scenario(Scenario.model_validate_json(args.scenario))
+        return
+
+    results: list[RunResult] = []
+    print(f"{'fetcher':<12}{'size':>8}{'run':>5}{'wall s':>9}{'api':>8}{'images':>8}{'304':>7}{'429':>6}{'slept s':>9}{'MB served':>11}{'MB written':>12}{'peak RSS MB':>13}")
+
+    for fetcher in args.fetchers:
+        for size in args.sizes:
+            config: FakeConfig = FakeConfig(
+                size=size,
+                latency=args.latency,
+                error_rate=args.error_rate,
+                retry_after=args.retry_after,
+                rate_limit=args.rate_limit,
+                rate_period=args.rate_period,
+                instances_per_event=args.instances_per_event,
+                image_size=args.image_size,
+                seed=args.seed,
+            )
+
+            # the runs share the work dir so the later ones measure an incremental sync
+            with TemporaryDirectory(prefix=f"benchmark-{fetcher}-{size}-") as work_dir:
+                for i in range(1, args.runs + 1):
+                    scenario: Scenario = Scenario(fetcher=fetcher, run=i, work_dir=work_dir, result_file=f"{work_dir}/result.json", config=config)
+                    log_file: Path = Path(work_dir) / f"run-{i}.log"
+
+                    with log_file.open("w") as log:
+                        process = run_process([sys.executable, __file__, "--scenario", scenario.model_dump_json()], cwd=SCRIPTS_DIR, stdout=log, stderr=log)
+
+                    if process.returncode != 0:
+                        print(f"{fetcher} {size} run {i} failed:\n" + "\n".join(log_file.read_text().splitlines()[-20:]), file=sys.stderr)
+                        sys.exit(process.returncode)
+
+                    result: RunResult = RunResult.model_validate_json(Path(scenario.result_file).read_text())
+                    results.append(result)
+                    print(
+                        f"{result.fetcher:<12}{result.size:>8}{result.run:>5}{result.wall_time:>9.2f}{result.api_calls:>8}{result.image_calls:>8}"
+                        f"{result.not_modified:>7}{result.rate_limited:>6}{result.throttled_seconds:>9.2f}{result.bytes_served / 2**20:>11.2f}"
+                        f"{result.bytes_written / 2**20:>12.2f}{result.peak_rss_mb:>13.1f}"
+                    )
+
+    if args.output:
+        Path(args.output).write_text(dumps([r.model_dump() for r in results], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+from os import replace, stat
+from os.path import join
+
+from anyio import to_thread, CapacityLimiter, Path
+from loguru import logger
+from pydantic import BaseModel
+
+
+def write_file(data_dir: str, name: str, content: bytes, exists: bool) -> bool:
+    """
+    Compare and write a single file, run in a worker thread so each file costs one hop off the event loop instead
+    of one for the read and another for the write. The content goes to a temporary file that is renamed over the
+    old one, so a run that is interrupted never leaves a half written file for the site build to choke on.
+    """
+    data_file: str = join(data_dir, name)
+
+    # a different size means the content changed without having to read the file back
+    if exists:
+        try:
+            if stat(data_file).st_size == len(content):
+                with open(data_file, "rb") as f:
+                    if f.read() == content:
+                        return False
+        except FileNotFoundError:
+            pass
+
+    temp_file: str = join(data_dir, f".{name}.tmp")
+    with open(temp_file, "wb") as f:
+        f.write(content)
+    replace(temp_file, data_file)
+    return True
+
+
+class DataWriter:
+    """
+    Writes the json files of a content collection directory incrementally. Files whose content did not change are
+    left untouched so Astro only reloads and git only commits what changed, and files that were not written during
+    the run are removed by finish(). Models are serialized straight to bytes by pydantic-core, indented unless the
+    writer is compact, and the files are compared and written by a bounded pool of worker threads.
+    """
+
+    def __init__(self, data_dir: Path, pattern: str = "*.json", compact: bool = False, threads: int = 8):
+        self.data_dir: Path = data_dir
+        self.pattern: str = pattern
+        self.compact: bool = compact
+        self.limiter: CapacityLimiter = CapacityLimiter(threads)
+        self.existing: set[str] = set()
+        self.written: set[str] = set()
+        self.added: int = 0
+        self.changed: int = 0
+        self.unchanged: int = 0
+
+    async def start(self) -> None:
+        await self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.existing = {f.name async for f in self.data_dir.glob(self.pattern)}
+
+    def dump(self, model: BaseModel, **kwargs) -> bytes:
+        # the same serializer model_dump_json uses, without decoding the bytes to a str only to encode them again
+        return model.__pydantic_serializer__.to_json(model, indent=None if self.compact else 2, **kwargs)
+
+    def count(self, name: str, changed: bool) -> bool:
+        self.written.add(name)
+        if name not in self.existing:
+            self.added += 1
+        elif changed:
+            self.changed += 1
+        else:
+            self.unchanged += 1
+
+        return changed
+
+    async def write(self, name: str, content: str | bytes) -> bool:
+        """
+        Write the file if its content changed, returns False when the file on disk was already up to date.
+        """
+        content = content.encode() if isinstance(content, str) else content
+        changed: bool = await to_thread.run_sync(write_file, str(self.data_dir), name, content, name in self.existing, limiter=self.limiter)
+        return self.count(name, changed)
+
+    async def write_model(self, name: str, model: BaseModel, **kwargs) -> bool:
+        return await self.write(name, self.dump(model, **kwargs))
+
+    async def write_models(self, models: dict[str, BaseModel], **kwargs) -> dict[str, bool]:
+        """
+        Write a batch of models in a single worker thread, returns whether each file changed by name.
+        """
+        data_dir: str = str(self.data_dir)
+        contents: dict[str, bytes] = {name: self.dump(model, **kwargs) for name, model in models.items()}
+        existing: set[str] = self.existing
+
+        def write_batch() -> dict[str, bool]:
+            return {name: write_file(data_dir, name, content, name in existing) for name, content in contents.items()}
+
+        changed: dict[str, bool] = await to_thread.run_sync(write_batch, limiter=self.limiter)
+        return {name: self.count(name, c) for name, c in changed.items()}
+
+    async def finish(self, prune: bool = True) -> None:
+        # a partial sync has not seen every file so it must not remove the ones it skipped
+        removed: set[str] = self.existing - self.written if prune else set()
+        for name in removed:
+            await (self.data_dir / name).unlink(missing_ok=True)
+
+        logger.info(f"{self.data_dir.name}: {self.added} added, {self.changed} changed, {self.unchanged} unchanged, {len(removed)} removed")
@@ -0,0 +1,203 @@
+from argparse import ArgumentParser, Namespace
+from hashlib import sha256
+from json import load
+from pathlib import Path
+from typing import MutableMapping, Optional
+
+from httpx import AsyncBaseTransport, Request, Response, URL
+from loguru import logger
+from pydantic import BaseModel
+from requests import PreparedRequest, Response as RequestsResponse, Session
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# the body is stored decoded so these no longer describe it
+STRIPPED_HEADERS: set[str] = {"content-encoding", "content-length", "transfer-encoding"}
+
+# conditional and range requests are recorded as plain ones so every entry holds the complete response, a replay
+# answers the revalidations from it
+CONDITIONAL_HEADERS: set[str] = {"if-modified-since", "if-none-match", "if-range", "range"}
+
+# responses without the complete body, these never replace what was recorded for the url
+PARTIAL_STATUS_CODES: set[int] = {206, 304}
+
+# the fixtures checked in next to the scripts, stored under their self link for replays to fall back to
+FIXTURES: list[str] = ["event_connections.json", "group_tags.json", "group_tag_groups.json"]
+
+
+class CassetteEntry(BaseModel):
+    method: str
+    url: str
+    status_code: int
+    headers: list[tuple[str, str]]
+
+
+class Cassette:
+    """
+    A directory of recorded HTTP interactions. In record mode every response is saved as it passes through, in
+    replay mode requests are answered from the directory so the fetchers run without credentials or network.
+    Each interaction is stored as a json entry plus the raw body, named by a hash of the method and url.
+    """
+
+    def __init__(self, cassette_dir: str, mode: str):
+        self.cassette_dir: Path = Path(cassette_dir)
+        self.mode: str = mode
+        self.recorded: Optional[dict[str, CassetteEntry]] = None
+        self.cassette_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def key(self, method: str, url: str, with_query: bool = True) -> str:
+        parsed: URL = URL(url)
+        params: str = "&".join(f"{k}={v}" for k, v in sorted(parsed.params.multi_items())) if with_query else ""
+        return sha256(f"{method.upper()} {parsed.copy_with(query=None)}?{params}".encode()).hexdigest()[:24]
+
+    def save(self, method: str, url: str, status_code: int, headers: list[tuple[str, str]], body: bytes, with_query: bool = True) -> None:
+        if status_code in PARTIAL_STATUS_CODES:
+            logger.debug(f"{method} {url}: {status_code} not recorded")
+            return
+
+        key: str = self.key(method, url, with_query)
+        headers = [(k, v) for k, v in headers if k.lower() not in STRIPPED_HEADERS]
+
+        entry: CassetteEntry = CassetteEntry(method=method.upper(), url=url, status_code=status_code, headers=headers)
+        (self.cassette_dir / f"{key}.json").write_text(entry.model_dump_json(indent=2))
+        (self.cassette_dir / f"{key}.body").write_bytes(body)
+
+    def unconditional(self, headers: MutableMapping[str, str]) -> None:
+        # drop the validators and ranges the fetchers send so the server answers with the whole body
+        for name in [name for name in headers if name.lower() in CONDITIONAL_HEADERS]:
+            del headers[name]
+
+    def closest(self, method: str, url: str) -> Optional[str]:
+        """
+        Return the key of the recorded request for the same path sharing the most query parameters, this lets a
+        replay match requests whose query changes from run to run like the date window of the calendar instances.
+        """
+        if self.recorded is None:
+            self.recorded = {f.stem: CassetteEntry.model_validate_json(f.read_text()) for f in self.cassette_dir.glob("*.json")}
+
+        parsed: URL = URL(url)
+        params: set[tuple[str, str]] = set(parsed.params.multi_items())
+        candidates: list[tuple[int, str]] = [
+            (len(params & set(URL(entry.url).params.multi_items())), key)
+            for key, entry in self.recorded.items()
+            if entry.method == method.upper() and URL(entry.url).copy_with(query=None) == parsed.copy_with(query=None)
+        ]
+
+        return max(candidates)[1] if candidates else None
+
+    def find(self, method: str, url: str) -> Optional[tuple[CassetteEntry, bytes]]:
+        # an exact match first then fall back to the closest recorded or seeded entry for the same path
+        for key in (self.key(method, url), self.closest(method, url)):
+            entry_file: Path = self.cassette_dir / f"{key}.json"
+            if key is not None and entry_file.exists():
+                entry: CassetteEntry = CassetteEntry.model_validate_json(entry_file.read_text())
+                return entry, (self.cassette_dir / f"{key}.body").read_bytes()
+
+        return None
+
+    def replay(self, method: str, url: str, request_headers: dict[str, str]) -> tuple[int, list[tuple[str, str]], bytes]:
+        found: Optional[tuple[CassetteEntry, bytes]] = self.find(method, url)
+        if found is None:
+            logger.warning(f"{method} {url}: not in cassette")
+            return 404, [("content-type", "application/json")], b'{"errors": [{"status": "404", "title": "Not in cassette"}]}'
+
+        entry, body = found
+
+        # answer revalidations like the server would so conditional downloads can be replayed
+        etag: Optional[str] = next((v for k, v in entry.headers if k.lower() == "etag"), None)
+        if etag is not None and request_headers.get("if-none-match") == etag:
+            return 304, [("etag", etag)], b""
+
+        return entry.status_code, entry.headers, body
+
+    def seed(self, fixtures_dir: Path) -> None:
+        for fixture in FIXTURES:
+            fixture_file: Path = fixtures_dir / fixture
+            url: str = load(fixture_file.open())["links"]["self"]
+            self.save("GET", url, 200, [("content-type", "application/json")], fixture_file.read_bytes(), with_query=False)
+            logger.info(f"{fixture}: seeded {url}")
+
+    def install(self, session: Session) -> None:
+        # route a requests session, e.g. the one the sermonaudio SDK uses, through the cassette
+        session.mount("https://", CassetteAdapter(self))
+        session.mount("http://", CassetteAdapter(self))
+
+
+class CassetteTransport(AsyncBaseTransport):
+    def __init__(self, cassette: Cassette, transport: AsyncBaseTransport):
+        self.cassette: Cassette = cassette
+        self.transport: AsyncBaseTransport = transport
+
+    async def handle_async_request(self, request: Request) -> Response:
+        if self.cassette.replaying:
+            status_code, headers, body = self.cassette.replay(request.method, str(request.url), dict(request.headers))
+            return Response(status_code, headers=headers, content=body, request=request)
+
+        self.cassette.unconditional(request.headers)
+        response: Response = await self.transport.handle_async_request(request)
+        body: bytes = await Response(response.status_code, headers=response.headers, stream=response.stream).aread()
+        await response.aclose()
+
+        headers: list[tuple[str, str]] = [(k, v) for k, v in response.headers.multi_items() if k.lower() not in STRIPPED_HEADERS]
+        self.cassette.save(request.method, str(request.url), response.status_code, headers, body)
+        return Response(response.status_code, headers=headers, content=body, request=request, extensions=response.extensions)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class CassetteAdapter(HTTPAdapter):
+    def __init__(self, cassette: Cassette):
+        super().__init__()
+        self.cassette: Cassette = cassette
+
+    def send(self, request: PreparedRequest, **kwargs) -> RequestsResponse:
+        if not self.cassette.replaying:
+            self.cassette.unconditional(request.headers)
+            response: RequestsResponse = super().send(request, **kwargs)
+            self.cassette.save(request.method, request.url, response.status_code, list(response.headers.items()), response.content)
+            return response
+
+        status_code, headers, body = self.cassette.replay(request.method, request.url, {k.lower(): v for k, v in request.headers.items()})
+
+        response: RequestsResponse = RequestsResponse()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response.url = request.url
+        response.request = request
+        return response
+
+
+def add_cassette_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument("--cassette-dir", type=str, help="record or replay every http interaction in this directory")
+    parser.add_argument("--cassette-mode", choices=["record", "replay"], default="replay")
+
+
+def cassette_from_args(args: Namespace) -> Optional[Cassette]:
+    return Cassette(args.cassette_dir, args.cassette_mode) if args.cassette_dir else None
+
+
+def parse_args():
+    """
+    Parse the command line arguments using the argparse library.
+
+    Returns:
+        Namespace: A Namespace object containing the parsed arguments.
+    """
+
+    parser = ArgumentParser(description="seed a cassette with the planning center fixtures")
+    parser.add_argument("--cassette-dir", type=str, required=True)
+    parser.add_argument("--fixtures-dir", type=str, default=str(Path(__file__).parent))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args: Namespace = parse_args()
+    Cassette(args.cassette_dir, "record").seed(Path(args.fixtures_dir))
@@ -0,0 +1,48 @@
+from typing import Generator, Optional
+
+from httpx import AsyncClient, AsyncHTTPTransport, Auth, BasicAuth, Limits, Request, Response, Timeout
+
+from http_cassette import Cassette, CassetteTransport
+
+
+class HostAuth(Auth):
+    """
+    Only authenticate requests for a single host, this lets the API credentials live on the shared client without
+    them being sent along with the image downloads from the CDN hosts.
+    """
+
+    def __init__(self, host: str, auth: Auth):
+        self.host: str = host
+        self.auth: Auth = auth
+
+    def auth_flow(self, request: Request) -> Generator[Request, Response, None]:
+        if request.url.host == self.host:
+            yield from self.auth.auth_flow(request)
+        else:
+            yield request
+
+
+def planningcenter_auth(client_id: Optional[str], secret: Optional[str]) -> Optional[Auth]:
+    # replaying a cassette needs no credentials
+    if client_id is None or secret is None:
+        return None
+
+    return HostAuth("api.planningcenteronline.com", BasicAuth(client_id, secret))
+
+
+def create_client(auth: Optional[Auth] = None, max_connections: int = 20, cassette: Optional[Cassette] = None) -> AsyncClient:
+    """
+    Create the long lived client shared by the API calls and image downloads of a run. The pool keeps connections
+    open over HTTP/2 so requests to the same hosts stop paying for a new TCP and TLS handshake every time.
+    """
+    transport: AsyncHTTPTransport = AsyncHTTPTransport(
+        http2=True,
+        limits=Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
+
+    return AsyncClient(
+        auth=auth,
+        transport=transport if cassette is None else CassetteTransport(cassette, transport),
+        follow_redirects=True,
+        timeout=Timeout(30.0),
+    )
@@ -0,0 +1,80 @@
+from argparse import ArgumentParser, Namespace
+from importlib.util import find_spec
+from shutil import copyfile
+from typing import Optional
+
+from anyio import to_process
+
+# the suffix of the site files of each format the derivatives can be transcoded to
+FORMAT_SUFFIX: dict[str, str] = {
+    "webp": ".webp",
+    "avif": ".avif",
+}
+
+
+def render_image(source: str, target: str, max_size: Optional[int], image_format: Optional[str], quality: int) -> bool:
+    """
+    Write the derivative of the source image to the target, run in a worker process. Returns False when the image
+    could not be re-encoded, e.g. an svg or an animated gif, in which case the source is copied as is.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(source) as original:
+            if image_format is None and original.format == "GIF":
+                copyfile(source, target)
+                return False
+
+            kind: str = (image_format or original.format).upper()
+            image = ImageOps.exif_transpose(original)
+            if max_size:
+                image.thumbnail((max_size, max_size))
+            if kind == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            image.save(target, kind, quality=quality, optimize=True)
+            return True
+    except (OSError, ValueError):
+        copyfile(source, target)
+        return False
+
+
+class Derivatives:
+    """
+    Settings of the optional derivative stage, the downloaded images are scaled down to fit the max size and
+    re-encoded, optionally to another format, in a pool of worker processes. The derivatives are cached in the
+    blob store by the hash of their source and the key of the settings, so only new images are rendered.
+    """
+
+    def __init__(self, max_size: Optional[int], image_format: Optional[str], quality: int):
+        self.max_size: Optional[int] = max_size
+        self.image_format: Optional[str] = image_format
+        self.quality: int = quality
+
+    @property
+    def key(self) -> str:
+        return f"{self.max_size or 'full'}-{self.image_format or 'same'}-q{self.quality}"
+
+    def suffix(self, suffix: str) -> str:
+        return FORMAT_SUFFIX[self.image_format] if self.image_format else suffix
+
+    async def render(self, source: str, target: str) -> bool:
+        return await to_process.run_sync(render_image, source, target, self.max_size, self.image_format, self.quality)
+
+
+def add_derivative_arguments(parser: ArgumentParser, transcode: bool = True) -> None:
+    parser.add_argument("--image-max-size", type=int, help="scale the downloaded images down to fit this many pixels")
+    parser.add_argument("--image-quality", type=int, default=82, help="quality the derivatives are encoded with")
+    if transcode:
+        parser.add_argument("--image-format", choices=list(FORMAT_SUFFIX), help="transcode the downloaded images to this format")
+
+
+def derivatives_from_args(args: Namespace) -> Optional[Derivatives]:
+    image_format: Optional[str] = getattr(args, "image_format", None)
+    if not args.image_max_size and not image_format:
+        return None
+
+    if find_spec("PIL") is None:
+        raise SystemExit("the image derivatives need pillow, install it with: uv sync --extra images")
+
+    return Derivatives(args.image_max_size, image_format, args.image_quality)
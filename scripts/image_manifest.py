@@ -0,0 +1,384 @@
+from hashlib import sha256
+from os import link, PathLike
+from pathlib import Path
+from shutil import copyfile
+from time import perf_counter, time
+from typing import Callable, Optional, Union
+from uuid import uuid4
+
+import anyio
+from httpx import AsyncClient, Headers, HTTPError, RemoteProtocolError, Response, TransportError, URL
+from loguru import logger
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+
+from image_derivatives import Derivatives
+from metrics import metrics
+
+
+class ManifestEntry(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    file: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    size: int
+    sha256: str
+    # the key of the derivative settings the file was rendered with, None for the downloaded image as is
+    derivative: Optional[str] = None
+
+    @property
+    def blob_id(self) -> str:
+        return f"{self.sha256}-{self.derivative}" if self.derivative else self.sha256
+
+
+MANIFEST_ENTRIES: TypeAdapter = TypeAdapter(dict[str, ManifestEntry])
+
+# times an interrupted download is resumed before giving up on it for this run
+MAX_RESUMES: int = 3
+
+# partial downloads and temporary files older than this are left over from runs that gave up on them
+STALE_TEMP_SECONDS: float = 7 * 24 * 60 * 60
+
+
+class PartialDownload:
+    """
+    The file an image is streamed into before it is added to the blob store, hashing and counting the bytes as they
+    arrive. It is named after the url and the validator of the response is kept next to it, so a download that was
+    interrupted, in this run or a previous one, resumes with a Range request from where it stopped as long as the
+    image has not changed since.
+    """
+
+    def __init__(self, temp_dir: Path, url: str):
+        key: str = sha256(url.encode()).hexdigest()[:24]
+        self.file: Path = temp_dir / f"{key}.part"
+        self.validator_file: Path = temp_dir / f"{key}.validator"
+        self.validator: Optional[str] = self.validator_file.read_text() if self.validator_file.exists() else None
+        self.digest = sha256()
+        self.size: int = 0
+
+    @property
+    def offset(self) -> int:
+        return self.file.stat().st_size if self.validator and self.file.exists() else 0
+
+    def range_headers(self) -> dict[str, str]:
+        # If-Range makes the server send the whole image again when it changed since the partial file was started
+        offset: int = self.offset
+        return {"Range": f"bytes={offset}-", "If-Range": self.validator} if offset else {}
+
+    def discard(self) -> None:
+        self.file.unlink(missing_ok=True)
+        self.validator_file.unlink(missing_ok=True)
+        self.validator = None
+
+    async def receive(self, response: Response) -> None:
+        """
+        Stream the response into the partial file, a 206 continues it and anything else starts it over. The bytes
+        received are checked against the Content-Length so a truncated image is never kept.
+        """
+        offset: int = self.offset if response.status_code == 206 else 0
+        if response.status_code == 206 and not response.headers.get("content-range", "").startswith(f"bytes {offset}-"):
+            self.discard()
+            raise RemoteProtocolError(f"unexpected content range {response.headers.get('content-range')}", request=response.request)
+
+        # only keep the validator when the server can resume from it
+        self.validator = response.headers.get("etag") or response.headers.get("last-modified")
+        if self.validator and (response.status_code == 206 or response.headers.get("accept-ranges") == "bytes"):
+            self.validator_file.write_text(self.validator)
+        else:
+            self.validator = None
+            self.validator_file.unlink(missing_ok=True)
+
+        self.digest = sha256()
+        self.size = 0
+        if offset:
+            async with await anyio.Path(self.file).open("rb") as f:
+                while chunk := await f.read(1 << 20):
+                    self.digest.update(chunk)
+                    self.size += len(chunk)
+
+        async with await anyio.Path(self.file).open("ab" if offset else "wb") as f:
+            async for chunk in response.aiter_bytes():
+                self.digest.update(chunk)
+                self.size += len(chunk)
+                await f.write(chunk)
+
+        # the length is of the bytes on the wire, which only match the ones written when they were not encoded
+        content_length: Optional[str] = response.headers.get("content-length")
+        received: int = response.num_bytes_downloaded if "content-encoding" in response.headers else self.size - offset
+        if content_length and content_length.isdigit() and received != int(content_length):
+            raise RemoteProtocolError(f"received {received} of {content_length} bytes", request=response.request)
+
+        self.validator_file.unlink(missing_ok=True)
+
+
+class BlobStore:
+    """
+    Content addressed store of the downloaded images shared by the fetchers. Every distinct image is kept once under
+    its sha256 and the site names are hardlinks to it, so a picture reused across blocks, pages or events takes its
+    disk space once and a site file that went missing is restored without downloading it again. Blobs are kept as
+    long as a manifest refers to them.
+    """
+
+    def __init__(self, store_dir: Union[str, PathLike]):
+        self.store_dir: Path = Path(store_dir)
+        self.temp_dir: Path = self.store_dir / ".tmp"
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
+
+    def blob(self, digest: str) -> Path:
+        return self.store_dir / digest[:2] / digest
+
+    def has(self, digest: str) -> bool:
+        return self.blob(digest).exists()
+
+    def temp_file(self) -> anyio.Path:
+        return anyio.Path(self.temp_dir / uuid4().hex)
+
+    def partial(self, url: str) -> PartialDownload:
+        return PartialDownload(self.temp_dir, url)
+
+    def add(self, temp_file: Union[str, PathLike], digest: str) -> None:
+        # the first download of an image becomes its blob, later downloads of the same content are dropped
+        blob: Path = self.blob(digest)
+        if blob.exists():
+            Path(temp_file).unlink()
+        else:
+            blob.parent.mkdir(exist_ok=True)
+            Path(temp_file).replace(blob)
+
+    def link(self, digest: str, image_file: Union[str, PathLike]) -> None:
+        blob: Path = self.blob(digest)
+        image_file = Path(image_file)
+        if image_file.exists() and image_file.samefile(blob):
+            return
+
+        # link through a temporary name so the site file is replaced in one step, and copy when the store is on
+        # another filesystem than the images
+        temp_file: Path = image_file.with_name(f".{image_file.name}.tmp")
+        temp_file.unlink(missing_ok=True)
+        try:
+            link(blob, temp_file)
+        except OSError:
+            copyfile(blob, temp_file)
+        temp_file.replace(image_file)
+
+    def referenced(self) -> set[str]:
+        """
+        Return the blobs referenced by the manifests of every fetcher that shares the store, along with the sources
+        of the derivatives so they are not downloaded again when the derivative settings change.
+        """
+        blob_ids: set[str] = set()
+        for manifest_file in self.store_dir.parent.glob("**/.*-manifest.json"):
+            for entry in MANIFEST_ENTRIES.validate_json(manifest_file.read_bytes()).values():
+                blob_ids.update((entry.sha256, entry.blob_id))
+
+        return blob_ids
+
+    def prune(self) -> None:
+        # a blob no manifest refers to is only taking up space, unless a site file still links it. the link count
+        # alone is not enough as the site files are copies when the store is on another filesystem than the images
+        referenced: set[str] = self.referenced()
+        removed: int = 0
+        for blob in self.store_dir.glob("??/*"):
+            if blob.name not in referenced and blob.stat().st_nlink == 1:
+                blob.unlink()
+                removed += 1
+
+        # partial downloads that were never resumed
+        for temp_file in self.temp_dir.iterdir():
+            if time() - temp_file.stat().st_mtime > STALE_TEMP_SECONDS:
+                temp_file.unlink()
+
+        logger.debug(f"{self.store_dir.name}: {removed} unused blobs removed")
+
+
+class ImageManifest:
+    """
+    Remembers which local file each image url was saved to along with the validators the server sent for it, so the
+    next run can request the image conditionally and keep the file on disk when the server answers 304 Not Modified.
+    The images themselves are written once into the blob store and linked under their site names, or their
+    derivatives are when the derivative stage is enabled.
+    """
+
+    def __init__(self, images_dir: Union[str, PathLike], name: str, store: BlobStore, derivatives: Optional[Derivatives] = None):
+        self.images_dir: Path = Path(images_dir)
+        self.store: BlobStore = store
+        self.derivatives: Optional[Derivatives] = derivatives
+        self.manifest_file: Path = self.images_dir / f".{name}-manifest.json"
+        self.entries: dict[str, ManifestEntry] = {}
+        self.used: set[str] = set()
+        self.files: set[str] = set()
+        self.links: set[str] = set()
+
+        if self.manifest_file.exists():
+            self.entries = MANIFEST_ENTRIES.validate_json(self.manifest_file.read_bytes())
+
+    def save(self, prune: bool = True) -> None:
+        # only keep the urls seen in this run so removed images drop out of the manifest, unless the run was partial
+        urls: set[str] = self.used if prune else self.used | self.entries.keys()
+        entries: dict[str, ManifestEntry] = {url: self.entries[url] for url in sorted(urls)}
+        self.manifest_file.write_bytes(MANIFEST_ENTRIES.dump_json(entries, indent=2))
+
+    def cached(self, url: str, file_name: Optional[str] = None) -> Optional[ManifestEntry]:
+        """
+        Return the entry for the url if its file is still on disk and untouched, or can be restored from the blob
+        store, otherwise None.
+        """
+        entry: Optional[ManifestEntry] = self.entries.get(url)
+        if entry is None or (file_name is not None and entry.file != file_name):
+            return None
+
+        # the file was rendered with other derivative settings so it has to be rendered again
+        if entry.derivative != (self.derivatives.key if self.derivatives else None):
+            return None
+
+        if not self.is_intact(entry, self.images_dir / entry.file) and not self.store.has(entry.blob_id):
+            return None
+
+        return entry
+
+    def is_intact(self, entry: ManifestEntry, image_file: Path) -> bool:
+        return image_file.exists() and image_file.stat().st_size == entry.size
+
+    def restore(self, entry: ManifestEntry, image_file: Path) -> None:
+        # link the file from the store again when it went missing, so it is only revalidated instead of downloaded
+        if not self.is_intact(entry, image_file):
+            logger.debug(f"{image_file.name}: restored from the store")
+            self.store.link(entry.blob_id, image_file)
+
+    def site_file(self, image_file: anyio.Path) -> anyio.Path:
+        # the derivatives may be transcoded to another format than the name the image was asked for says
+        return image_file.with_suffix(self.derivatives.suffix(image_file.suffix)) if self.derivatives else image_file
+
+    def conditional_headers(self, entry: Optional[ManifestEntry]) -> dict[str, str]:
+        headers: dict[str, str] = {}
+
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        return headers
+
+    def not_modified(self, url: str, entry: ManifestEntry) -> str:
+        logger.trace(f"{entry.file}: not modified")
+        self.used.add(url)
+        self.files.add(entry.file)
+        return entry.file
+
+    def failed(self, url: str, error: HTTPError, image_file: Optional[anyio.Path] = None) -> Optional[str]:
+        """
+        Count an image that could not be downloaded and keep its file from the last run, so one broken url does not
+        fail the whole run. Returns the name of the kept file, or None when there is no usable file to keep.
+        """
+        metrics.error(f"images.{URL(url).host}")
+        entry: Optional[ManifestEntry] = self.cached(url, self.site_file(image_file).name if image_file is not None else None)
+        if entry is None:
+            logger.warning(f"{url}: could not be downloaded: {error}")
+            return None
+
+        self.restore(entry, self.images_dir / entry.file)
+        logger.warning(f"{url}: could not be downloaded, keeping {entry.file}: {error}")
+        return self.not_modified(url, entry)
+
+    def record(self, url: str, file_name: str, headers: Headers, size: int, digest: str) -> str:
+        self.entries[url] = ManifestEntry(
+            file=file_name,
+            etag=headers.get("etag"),
+            last_modified=headers.get("last-modified"),
+            size=size,
+            sha256=digest,
+            derivative=self.derivatives.key if self.derivatives else None,
+        )
+        self.used.add(url)
+        self.files.add(file_name)
+        return file_name
+
+    async def download(self, client: AsyncClient, url: str, image_file: Union[anyio.Path, Callable[[Response], anyio.Path]]) -> str:
+        """
+        Download the url into the images dir and return the file name. The image file is either a fixed path or
+        computed from the response, in which case the file the url was last saved to is revalidated.
+        """
+        if isinstance(image_file, anyio.Path):
+            image_file = self.site_file(image_file)
+        file_name: Optional[str] = image_file.name if isinstance(image_file, anyio.Path) else None
+        entry: Optional[ManifestEntry] = self.cached(url, file_name)
+        if entry is not None:
+            self.restore(entry, self.images_dir / entry.file)
+
+        partial: PartialDownload = self.store.partial(url)
+        for attempt in range(MAX_RESUMES + 1):
+            # resume an interrupted download of the image, otherwise revalidate the file from the last run
+            headers: dict[str, str] = partial.range_headers() or self.conditional_headers(entry)
+
+            start: float = perf_counter()
+            async with client.stream("GET", url, headers=headers) as response:
+                metrics.call(f"images.{response.url.host}", perf_counter() - start)
+                if entry is not None and response.status_code == 304:
+                    partial.discard()
+                    return self.not_modified(url, entry)
+
+                # the partial file is no longer a prefix of the image the server has so start over
+                if response.status_code == 416 and "Range" in headers:
+                    partial.discard()
+                    continue
+
+                response.raise_for_status()
+                if not isinstance(image_file, anyio.Path):
+                    image_file = self.site_file(image_file(response))
+
+                try:
+                    await partial.receive(response)
+                    break
+                except TransportError as e:
+                    if attempt == MAX_RESUMES:
+                        raise
+                    logger.warning(f"{url}: interrupted after {partial.size} bytes, {'resuming' if partial.offset else 'retrying'}: {e}")
+        else:
+            # the last attempt was a range the server no longer satisfies, so nothing was received
+            raise RemoteProtocolError(f"{url}: not downloaded after {MAX_RESUMES + 1} attempts")
+
+        digest = partial.digest
+        metrics.received(partial.size)
+        self.store.add(partial.file, digest.hexdigest())
+
+        blob_id: str = await self.derive(digest.hexdigest())
+        self.store.link(blob_id, image_file)
+        return self.record(url, image_file.name, response.headers, self.store.blob(blob_id).stat().st_size, digest.hexdigest())
+
+    async def derive(self, digest: str) -> str:
+        """
+        Return the id of the blob the site file links to, rendering the derivative of the image when the derivative
+        stage is enabled and the image has not been rendered with the same settings before.
+        """
+        if self.derivatives is None:
+            return digest
+
+        blob_id: str = f"{digest}-{self.derivatives.key}"
+        if not self.store.has(blob_id):
+            temp_file: anyio.Path = self.store.temp_file()
+            with metrics.phase("derive"):
+                if not await self.derivatives.render(str(self.store.blob(digest)), str(temp_file)):
+                    logger.warning(f"{digest}: could not be re-encoded, keeping the original")
+            self.store.add(temp_file, blob_id)
+
+        return blob_id
+
+    def link(self, url: str, image_file: anyio.Path) -> None:
+        """
+        Link the image the url was downloaded to under another name that references the same image, so the image
+        is only requested once.
+        """
+        image_file = self.site_file(image_file)
+        self.store.link(self.entries[url].blob_id, image_file)
+        self.links.add(image_file.name)
+
+    async def prune(self, pattern: str) -> None:
+        # remove the images matching the pattern that were not written, revalidated or linked in this run, the hidden
+        # files are the manifests and the temporary link names and are never images
+        keep: set[str] = self.files | self.links
+
+        async for image_file in anyio.Path(self.images_dir).glob(pattern):
+            if image_file.name not in keep and not image_file.name.startswith("."):
+                logger.debug(f"{image_file.name}: removed")
+                await image_file.unlink()
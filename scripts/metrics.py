@@ -0,0 +1,105 @@
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from json import dumps
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, Optional
+
+from loguru import logger
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS: list[float] = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.calls: int = 0
+        self.rate_limited: int = 0
+        self.errors: int = 0
+        self.seconds: float = 0.0
+        self.max_seconds: float = 0.0
+        self.buckets: list[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds: float) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def summary(self) -> dict:
+        labels: list[str] = [f"<={b}" for b in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}"]
+        return {
+            "calls": self.calls,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "seconds": round(self.seconds, 3),
+            "mean_seconds": round(self.seconds / self.calls, 3) if self.calls else None,
+            "max_seconds": round(self.max_seconds, 3),
+            "latency": dict(zip(labels, self.buckets)),
+        }
+
+
+class PhaseMetrics:
+    def __init__(self):
+        self.count: int = 0
+        self.seconds: float = 0.0
+
+
+class Metrics:
+    """
+    Collects where a run spends its time: calls, latencies and 429s per endpoint, the time slept waiting on the
+    rate limit, bytes received and the time spent in each phase. Phases entered by concurrent tasks add up the
+    time of every task, so they can exceed the wall time of the run.
+    """
+
+    def __init__(self):
+        self.started: float = perf_counter()
+        self.endpoints: dict[str, EndpointMetrics] = defaultdict(EndpointMetrics)
+        self.phases: dict[str, PhaseMetrics] = defaultdict(PhaseMetrics)
+        self.throttled_seconds: float = 0.0
+        self.bytes_received: int = 0
+
+    def call(self, endpoint: str, seconds: float) -> None:
+        self.endpoints[endpoint].record(seconds)
+
+    def rate_limited(self, endpoint: str) -> None:
+        self.endpoints[endpoint].rate_limited += 1
+
+    def error(self, endpoint: str) -> None:
+        self.endpoints[endpoint].errors += 1
+
+    def throttled(self, seconds: float) -> None:
+        self.throttled_seconds += seconds
+
+    def received(self, size: int) -> None:
+        self.bytes_received += size
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start: float = perf_counter()
+        try:
+            yield
+        finally:
+            phase: PhaseMetrics = self.phases[name]
+            phase.count += 1
+            phase.seconds += perf_counter() - start
+
+    def summary(self) -> dict:
+        return {
+            "wall_seconds": round(perf_counter() - self.started, 3),
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "bytes_received": self.bytes_received,
+            "phases": {name: {"count": p.count, "seconds": round(p.seconds, 3)} for name, p in sorted(self.phases.items())},
+            "endpoints": {name: e.summary() for name, e in sorted(self.endpoints.items())},
+        }
+
+    def report(self, metrics_file: Optional[str] = None) -> None:
+        summary: str = dumps(self.summary(), indent=2)
+        logger.info(f"metrics:\n{summary}")
+
+        if metrics_file:
+            Path(metrics_file).write_text(summary)
+
+
+metrics: Metrics = Metrics()
@@ -1,109 +1,220 @@
-from datetime import datetime, UTC
 from functools import wraps
-from typing import Callable, AsyncIterator
+from random import uniform
+from typing import Any, Callable, AsyncIterator, Optional
 
-from anyio import sleep
+from anyio import create_task_group, current_time, sleep, Event, Lock
 from decorest import backend, content, endpoint, on, query, GET, RestClient
+from decorest.errors import HTTPErrorWrapper
+from httpx import AsyncClient, Headers, Response
 from loguru import logger
+from pydantic import TypeAdapter
+
+from metrics import metrics
+from planningcenter_api_models import (
+    CalendarInstancesPage,
+    ConnectedEventsPage,
+    EventConnection,
+    GroupTag,
+    GroupTagGroup,
+    Page,
+    RegistrationEvent,
+    Resource,
+    TaggedGroupsPage,
+)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the Planning Center clients. Planning Center allows 100 requests per 20 second
+    period for the whole application, so the bucket refills at limit / period and is corrected by the
+    X-PCO-API-Request-Rate-* headers returned with every response.
+    """
+
+    def __init__(self, limit: int = 100, period: float = 20.0):
+        self.limit: int = limit
+        self.period: float = period
+        self.tokens: float = float(limit)
+        self.updated: Optional[float] = None
+        self.blocked_until: float = 0.0
+        self.lock: Lock = Lock()
+
+    def refill(self, now: float) -> None:
+        if self.updated is not None:
+            self.tokens = min(float(self.limit), self.tokens + (now - self.updated) * self.limit / self.period)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        # the lock queues callers so tokens are handed out in the order they were requested
+        async with self.lock:
+            while True:
+                now: float = current_time()
+                self.refill(now)
+
+                if now < self.blocked_until:
+                    delay: float = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay: float = (1 - self.tokens) * self.period / self.limit
+
+                logger.trace(f"Rate limited, sleeping {delay:.2f}s")
+                metrics.throttled(delay)
+                await sleep(delay)
+
+    def update(self, headers: Headers) -> None:
+        # the server counts every request made with our credentials so trust it over the local bucket
+        if "X-PCO-API-Request-Rate-Limit" in headers and "X-PCO-API-Request-Rate-Period" in headers:
+            self.limit = int(headers["X-PCO-API-Request-Rate-Limit"])
+            self.period = float(headers["X-PCO-API-Request-Rate-Period"])
+
+        if "X-PCO-API-Request-Rate-Count" in headers:
+            self.refill(current_time())
+            remaining: int = self.limit - int(headers["X-PCO-API-Request-Rate-Count"])
+            self.tokens = min(self.tokens, float(max(remaining, 0)))
+
+    def throttle(self, delay: float) -> None:
+        # block every caller until the server is ready to accept requests again
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, current_time() + delay)
+
+
+rate_limiter: RateLimiter = RateLimiter()
+
+
+def backoff_delay(response: Response, attempt: int) -> float:
+    # prefer the server's retry after header otherwise back off exponentially with jitter
+    retry_after: Optional[str] = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+
+    delay: float = min(rate_limiter.period, float(2**attempt))
+    return delay / 2 + uniform(0, delay / 2)
+
 
-total_api_calls: int = 0
-start_time: datetime = datetime.now(tz=UTC)
+def validated(document: type) -> Callable[[Response], Any]:
+    """
+    Build the response handler of an endpoint, the adapter is built once and validates the whole document
+    straight from the response body without going through an intermediate dict.
+    """
+    adapter: TypeAdapter = TypeAdapter(document)
+
+    def handler(response: Response) -> Any:
+        rate_limiter.update(response.headers)
+        metrics.received(len(response.content))
+        return adapter.validate_json(response.content)
+
+    return handler
 
 
 def retry_on_rate_limit(func):
     @wraps(func)
     async def wrapper(*args, **kwargs):
+        endpoint: str = f"{type(args[0]).__name__}.{func.__name__}"
+        attempt: int = 0
         while True:
-            # compute the rate of api calls since the script started
-            global total_api_calls
-            total_api_calls += 1
-            elapsed = datetime.now(tz=UTC) - start_time
-
-            if elapsed.total_seconds() > 0:
-                seconds: float = elapsed.total_seconds()
-                rate = total_api_calls / seconds
-                logger.trace(f"API calls per second: {rate}")
-
-                if rate > 4:
-                    # planning center generally has a 20 second quota period or 5/sec so undershoot for 4/sec
-                    # sleep for enough time to get the rate under 100 / 20
-
-                    # t = 5 * (e + d)
-                    # t = 5e + 5d
-                    # d = (t - 5e) / 5
+            await rate_limiter.acquire()
 
-                    delay: float = (total_api_calls - (4 * seconds)) / 4
-                    await sleep(delay)
+            # send the request through the shared connection pool when the client was given one
+            client: Optional[AsyncClient] = getattr(args[0], "client", None)
+            if client is not None:
+                kwargs["__session"] = client
 
+            start: float = current_time()
             try:
                 return await func(*args, **kwargs)
-            except Exception as e:
+            except HTTPErrorWrapper as e:
+                # a transport error or a response that fails validation is not an http error and is raised as is
                 if e.response.status_code == 429:
-                    # planning center generally has a 20 second quota period
-                    await sleep(5)
+                    metrics.rate_limited(endpoint)
+                    rate_limiter.update(e.response.headers)
+                    delay: float = backoff_delay(e.response, attempt)
+                    logger.warning(f"{func.__name__}: rate limited by planning center, retrying in {delay:.2f}s")
+                    rate_limiter.throttle(delay)
+                    attempt += 1
                 else:
+                    metrics.error(endpoint)
                     raise
+            except Exception:
+                metrics.error(endpoint)
+                raise
+            finally:
+                metrics.call(endpoint, current_time() - start)
 
     return wrapper
 
 
-def lookup_related(d: dict, included: dict) -> dict:
-    related_output: dict = {}
+def single_flight(func):
+    """
+    Memoize an async function for the rest of the run. Concurrent callers with the same arguments
+    share the one in-flight call, if it fails the next waiting caller retries it.
+    """
+    results: dict = {}
+    pending: dict[tuple, Event] = {}
 
-    if "relationships" in d:
-        for key, value in d["relationships"].items():
-            relationship = value["data"]
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        key: tuple = (args, tuple(sorted(kwargs.items())))
 
-            match relationship:
-                case dict():
-                    related_id = relationship["id"]
-                    related_data = included.get(related_id)
+        while key not in results:
+            if key in pending:
+                # another caller is already fetching this key so wait for it to finish
+                await pending[key].wait()
+                continue
 
-                    # check if we should recurse
-                    if related_data and "relationships" in related_data:
-                        related_data.update(lookup_related(related_data, included))
+            pending[key] = Event()
+            try:
+                results[key] = await func(*args, **kwargs)
+            finally:
+                pending.pop(key).set()
 
-                    related_output[key] = related_data
+        return results[key]
+
+    return wrapper
 
-                case list():
-                    for related_item in value["data"]:
-                        related_id = related_item["id"]
-                        related_data = included.get(related_id)
 
-                        # check if we should recurse
-                        if related_data and "relationships" in related_data:
-                            related_data.update(lookup_related(related_data, included))
+async def paginate(method: Callable, *args, per_page=100, concurrency=1) -> AsyncIterator[Any]:
+    """
+    Iterate the items of a paged listing in order. The first page tells us the total count, with a concurrency
+    above one the remaining pages are then requested that many at a time instead of one after another.
+    """
+    resp: Page = await method(0, per_page, *args)
+    for d in resp.items():
+        yield d
 
-                        if key not in related_output:
-                            related_output[key] = []
-                        related_output[key].append(related_data)
+    offsets: list[int] = list(range(per_page, resp.meta.total_count, per_page))
 
-    return related_output
+    for i in range(0, len(offsets), concurrency):
+        pages: dict[int, Page] = {}
 
+        async def fetch_page(offset: int):
+            pages[offset] = await method(offset, per_page, *args)
 
-async def paginate(method: Callable, *args, per_page=100) -> AsyncIterator[tuple[dict, dict]]:
-    offset: int = 0
+        # fetch the window of pages concurrently and yield outside the task group so items stay in order
+        async with create_task_group() as tg:
+            for offset in offsets[i : i + concurrency]:
+                tg.start_soon(fetch_page, offset)
 
-    while True:
-        resp = await method(offset, per_page, *args)
-        data = resp["data"]
-        included = {i["id"]: i for i in resp["included"]}
+        for offset in offsets[i : i + concurrency]:
+            for d in pages[offset].items():
+                yield d
 
-        for d in data:
-            d.update(lookup_related(d, included))
-            yield d
 
-        meta = resp["meta"]
-        if offset + meta["count"] < meta["total_count"]:
-            offset += per_page
-        else:
-            break
+class PlanningCenterClient(RestClient):
+    """
+    Base of the Planning Center clients. When given a shared httpx client every request is sent through its
+    connection pool, which must then carry the credentials, otherwise decorest opens a new client per request.
+    """
+
+    def __init__(self, client: Optional[AsyncClient] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.client: Optional[AsyncClient] = client
 
 
 @backend("httpx")
 @endpoint("https://api.planningcenteronline.com/calendar/v2")
 @content("application/json")
-class Calendar(RestClient):
+class Calendar(PlanningCenterClient):
 
     @retry_on_rate_limit
     @GET("calendar_instances")
@@ -119,7 +230,7 @@ class Calendar(RestClient):
     @query("order")
     @query("offset")
     @query("per_page")
-    @on(200, lambda r: r.json())
+    @on(200, validated(CalendarInstancesPage))
     async def calendar_instances_list(
         self,
         offset,
@@ -136,10 +247,26 @@ class Calendar(RestClient):
         order="starts_at,ends_at",
     ): ...
 
+    @retry_on_rate_limit
+    @GET("events")
+    @query("filter")
+    @query("include")
+    @query("offset")
+    @query("per_page")
+    @on(200, validated(ConnectedEventsPage))
+    async def events_list(
+        self,
+        offset,
+        per_page,
+        filter="future",
+        include="event_connections",
+    ): ...
+
+    @single_flight
     @retry_on_rate_limit
     @GET("events/{event_id}/event_connections")
     # @query("where_product_name", "where[product_name]")
-    @on(200, lambda r: r.json())
+    @on(200, validated(Page[EventConnection]))
     async def event_connections(
         self,
         event_id,
@@ -150,22 +277,37 @@ class Calendar(RestClient):
 @backend("httpx")
 @endpoint("https://api.planningcenteronline.com/groups/v2")
 @content("application/json")
-class Groups(RestClient):
+class Groups(PlanningCenterClient):
+    @single_flight
     @retry_on_rate_limit
     @GET("groups/{group_id}")
-    @on(200, lambda r: r.json())
+    @on(200, validated(Resource[dict]))
     async def group(self, group_id): ...
 
+    @retry_on_rate_limit
+    @GET("groups")
+    @query("include")
+    @query("offset")
+    @query("per_page")
+    @on(200, validated(TaggedGroupsPage))
+    async def groups_list(
+        self,
+        offset,
+        per_page,
+        include="tags",
+    ): ...
+
+    @single_flight
     @retry_on_rate_limit
     @GET("groups/{group_id}/tags")
-    @on(200, lambda r: r.json())
+    @on(200, validated(Page[GroupTag]))
     async def group_tags(self, group_id): ...
 
     @retry_on_rate_limit
     @GET("tag_groups")
     @query("offset")
     @query("per_page")
-    @on(200, lambda r: r.json())
+    @on(200, validated(Page[GroupTagGroup]))
     async def tag_groups(
         self,
         offset,
@@ -176,14 +318,14 @@ class Groups(RestClient):
 @backend("httpx")
 @endpoint("https://api.planningcenteronline.com/publishing/v2")
 @content("application/json")
-class Publishing(RestClient):
+class Publishing(PlanningCenterClient):
 
     @retry_on_rate_limit
     @GET("pages")
     @query("filter")
     @query("offset")
     @query("per_page")
-    @on(200, lambda r: r.json())
+    @on(200, validated(Page[dict]))
     async def pages_list(
         self,
         offset,
@@ -195,9 +337,10 @@ class Publishing(RestClient):
 @backend("httpx")
 @endpoint("https://api.planningcenteronline.com/registrations/v2")
 @content("application/json")
-class Registrations(RestClient):
+class Registrations(PlanningCenterClient):
 
+    @single_flight
     @retry_on_rate_limit
     @GET("events/{event_id}")
-    @on(200, lambda r: r.json())
+    @on(200, validated(Resource[RegistrationEvent]))
     async def event(self, event_id): ...
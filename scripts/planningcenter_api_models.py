@@ -1,8 +1,10 @@
 from datetime import datetime
 from enum import StrEnum
-from typing import Annotated, Literal, Optional
+from typing import Annotated, Any, Generic, Literal, Optional, Self, TypeVar
 
-from pydantic import AliasPath, BaseModel, ConfigDict, Field
+from pydantic import AliasPath, BaseModel, ConfigDict, Discriminator, Field, model_validator, Tag as UnionTag
+
+T = TypeVar("T")
 
 
 class EventApprovalStatus(StrEnum):
@@ -11,9 +13,16 @@ class EventApprovalStatus(StrEnum):
     REJECTED = "R"
 
 
-class RegistrationEvent(BaseModel):
+class ResourceIdentifier(BaseModel):
     model_config = ConfigDict(extra="ignore")
 
+    type: str
+    id: str
+
+
+class RegistrationEvent(BaseModel):
+    model_config = ConfigDict(extra="ignore", populate_by_name=True)
+
     id: str
 
     at_maximum_capacity: bool = Field(validation_alias=AliasPath("attributes", "at_maximum_capacity"))
@@ -32,7 +41,18 @@ class Tag(BaseModel):
 
     color: str = Field(validation_alias=AliasPath("attributes", "color"))
     name: str = Field(validation_alias=AliasPath("attributes", "name"))
-    group: str = Field(validation_alias=AliasPath("tag_group", "attributes", "name"))
+    # the name of the tag group, resolved from the included tag groups of the page, a missing one fails the page
+    group: str = ""
+
+    tag_group_ref: Optional[ResourceIdentifier] = Field(None, validation_alias=AliasPath("relationships", "tag_group", "data"), exclude=True)
+
+
+class TagGroup(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    id: str
+
+    name: str = Field(validation_alias=AliasPath("attributes", "name"))
 
 
 class Event(BaseModel):
@@ -90,6 +110,9 @@ class CalendarInstance(BaseModel):
     ministry: Optional[str] = "default"
     color: Optional[str] = "#6ADCC8"
 
+    event_ref: Optional[ResourceIdentifier] = Field(None, validation_alias=AliasPath("relationships", "event", "data"), exclude=True)
+    tag_refs: list[ResourceIdentifier] = Field(default_factory=list, validation_alias=AliasPath("relationships", "tags", "data"), exclude=True)
+
 
 class GroupTag(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -244,3 +267,124 @@ class PageInstance(BaseModel):
     id: str
     type: Literal["Page"]
     attr: PageAttributes = Field(alias="attributes")
+
+
+class PageMeta(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    total_count: int = 0
+
+
+class Resource(BaseModel, Generic[T]):
+    """
+    A single resource response, e.g. the registration event of a signup.
+    """
+
+    model_config = ConfigDict(extra="ignore")
+
+    data: T
+
+
+class Page(BaseModel, Generic[T]):
+    """
+    A page of a listing, validated as a whole straight from the response body. Pages with included resources
+    resolve the relationships of their items in items().
+    """
+
+    model_config = ConfigDict(extra="ignore")
+
+    data: list[T]
+    meta: PageMeta = Field(default_factory=PageMeta)
+
+    def items(self) -> list[T]:
+        return self.data
+
+
+def included_type(value: Any) -> str:
+    kind: Optional[str] = value.get("type") if isinstance(value, dict) else None
+    return kind if kind in ("Event", "Tag", "TagGroup") else "Resource"
+
+
+Included = Annotated[
+    Annotated[Event, UnionTag("Event")] | Annotated[Tag, UnionTag("Tag")] | Annotated[TagGroup, UnionTag("TagGroup")] | Annotated[ResourceIdentifier, UnionTag("Resource")],
+    Discriminator(included_type),
+]
+
+
+class CalendarInstancesPage(Page[CalendarInstance]):
+    included: list[Included] = Field(default_factory=list)
+
+    @model_validator(mode="after")
+    def resolve_tag_groups(self) -> Self:
+        # every tag belongs to a tag group, so a tag whose group was not included is as invalid as the page
+        tag_groups: dict[str, TagGroup] = {r.id: r for r in self.included if isinstance(r, TagGroup)}
+        for tag in self.included:
+            if isinstance(tag, Tag):
+                if tag.tag_group_ref is None or tag.tag_group_ref.id not in tag_groups:
+                    raise ValueError(f"tag {tag.id} is missing its tag group")
+                tag.group = tag_groups[tag.tag_group_ref.id].name
+
+        return self
+
+    def items(self) -> list[CalendarInstance]:
+        events: dict[str, Event] = {r.id: r for r in self.included if isinstance(r, Event)}
+        tags: dict[str, Tag] = {r.id: r for r in self.included if isinstance(r, Tag)}
+
+        for instance in self.data:
+            # every recurrence of an event gets its own copy as the image url is rewritten per instance
+            if instance.event_ref is not None and instance.event_ref.id in events:
+                instance.event = events[instance.event_ref.id].model_copy()
+            instance.tags = [tags[r.id] for r in instance.tag_refs if r.id in tags]
+
+        return self.data
+
+
+class ConnectedEvent(BaseModel):
+    """
+    An event of the events listing, only the connections included with it are kept.
+    """
+
+    model_config = ConfigDict(extra="ignore")
+
+    id: str
+
+    connection_refs: Optional[list[ResourceIdentifier]] = Field(None, validation_alias=AliasPath("relationships", "event_connections", "data"))
+    event_connections: Optional[list[EventConnection]] = None
+
+
+class ConnectedEventsPage(Page[ConnectedEvent]):
+    included: list[EventConnection] = Field(default_factory=list)
+
+    def items(self) -> list[ConnectedEvent]:
+        # only trust the events every connection was included for, the others are looked up on their own
+        connections: dict[str, EventConnection] = {c.id: c for c in self.included}
+        for event in self.data:
+            if event.connection_refs is not None and all(r.id in connections for r in event.connection_refs):
+                event.event_connections = [connections[r.id] for r in event.connection_refs]
+
+        return self.data
+
+
+class TaggedGroup(BaseModel):
+    """
+    A group of the groups listing, only the tags included with it are kept.
+    """
+
+    model_config = ConfigDict(extra="ignore")
+
+    id: str
+
+    tag_refs: Optional[list[ResourceIdentifier]] = Field(None, validation_alias=AliasPath("relationships", "tags", "data"))
+    tags: Optional[list[GroupTag]] = None
+
+
+class TaggedGroupsPage(Page[TaggedGroup]):
+    included: list[GroupTag] = Field(default_factory=list)
+
+    def items(self) -> list[TaggedGroup]:
+        tags: dict[str, GroupTag] = {t.id: t for t in self.included}
+        for group in self.data:
+            if group.tag_refs is not None and all(r.id in tags for r in group.tag_refs):
+                group.tags = [tags[r.id] for r in group.tag_refs]
+
+        return self.data
@@ -1,18 +1,27 @@
 from argparse import ArgumentParser, Namespace
 from datetime import datetime, timedelta, UTC
-from functools import cache
+from json import dumps
 from os import environ
-from shutil import rmtree
+from typing import Callable, Optional
 from urllib.parse import ParseResult, urlparse
 
-from anyio import run, Path
-from cache import AsyncLRU
+from anyio import create_memory_object_stream, create_task_group, run, Path
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from decorest.errors import HTTPErrorWrapper
 from dotenv import load_dotenv
-from httpx import BasicAuth, AsyncClient
+from httpx import Auth, AsyncClient, HTTPStatusError, Response, TransportError
 from loguru import logger
-
+from pydantic import BaseModel, ConfigDict, Field
+
+from data_writer import DataWriter
+from http_cassette import add_cassette_arguments, cassette_from_args
+from http_client import create_client, planningcenter_auth
+from image_derivatives import add_derivative_arguments, derivatives_from_args
+from image_manifest import BlobStore, ImageManifest
+from metrics import metrics
 from planningcenter_api import (
     paginate,
+    single_flight,
     Calendar,
     Groups,
     Registrations,
@@ -20,13 +29,18 @@ from planningcenter_api import (
 
 from planningcenter_api_models import (
     CalendarInstance,
+    ConnectedEvent,
+    Event,
     EventConnection,
     GroupTag,
     GroupTagGroup,
     RegistrationEvent,
+    TaggedGroup,
 )
 
 
+PAGE_SIZE: int = 100
+
 MINISTRY_TAG_TO_SLUG: dict[str, str] = {
     "Children's Ministry": "children",
     "Counseling": "counseling",
@@ -81,21 +95,333 @@ CONTENT_TYPE_TO_SUFFIX: dict[str, str] = {
 }
 
 
-@AsyncLRU()
-async def download_image(images_dir: Path, image_url: str):
+@single_flight
+async def download_image(client: AsyncClient, manifest: ImageManifest, images_dir: Path, image_url: str) -> Optional[str]:
     image_name: str = generate_image_name(image_url)
 
-    async with AsyncClient() as client:
-        async with client.stream("GET", image_url) as response:
-            content_type: str = response.headers["content-type"]
-            suffix: str = CONTENT_TYPE_TO_SUFFIX[content_type.lower()]
-            image_file: Path = images_dir / f"{image_name}{suffix}"
+    def image_file(response: Response) -> Path:
+        content_type: str = response.headers["content-type"]
+        suffix: str = CONTENT_TYPE_TO_SUFFIX[content_type.lower()]
+        return images_dir / f"{image_name}{suffix}"
+
+    try:
+        return await manifest.download(client, image_url, image_file)
+    except (HTTPStatusError, TransportError) as e:
+        return manifest.failed(image_url, e)
+
+
+class EventSyncEntry(BaseModel):
+    updated_at: datetime
+    instance_id: str
+
+
+class EventSyncState(BaseModel):
+    full_refresh_at: Optional[datetime] = None
+    events: dict[str, EventSyncEntry] = Field(default_factory=dict)
 
-            async with await image_file.open("wb") as f:
-                async for chunk in response.aiter_bytes():
-                    await f.write(chunk)
 
-    return image_file.name
+class StoredEnrichment(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    group_tags: dict[str, str] = Field(default_factory=dict)
+    registration: Optional[RegistrationEvent] = None
+
+
+class EventSync:
+    """
+    Tracks the updated_at watermark of every event as of the last successful run. Events that have not been
+    updated since then reuse the group tags and registration stored in their on-disk json instead of looking them
+    up again, and every so often a full refresh picks up changes that do not touch the event itself.
+    """
+
+    def __init__(self, state_file: Path, full_refresh: timedelta):
+        self.state_file: Path = state_file
+        self.full_refresh: timedelta = full_refresh
+        self.state: EventSyncState = EventSyncState()
+        self.stored: dict[str, StoredEnrichment] = {}
+        self.synced: dict[str, EventSyncEntry] = {}
+        self.starts_at: dict[str, datetime] = {}
+        self.is_full_refresh: bool = True
+
+    async def load(self, events_dir: Path) -> None:
+        if await self.state_file.exists():
+            self.state = EventSyncState.model_validate_json(await self.state_file.read_text())
+
+        now: datetime = datetime.now(tz=UTC)
+        self.is_full_refresh = self.state.full_refresh_at is None or now - self.state.full_refresh_at >= self.full_refresh
+        if self.is_full_refresh:
+            logger.info("Full refresh of event connections")
+            return
+
+        # read the enrichment of every event up front, the instance files are rewritten while the run is going
+        for event_id, entry in self.state.events.items():
+            event_file: Path = events_dir / f"{entry.instance_id}.json"
+            if await event_file.exists():
+                self.stored[event_id] = StoredEnrichment.model_validate_json(await event_file.read_text())
+
+    def enrichment(self, event: Event) -> Optional[StoredEnrichment]:
+        """
+        Return the stored enrichment of the event when it has not been updated since the last run.
+        """
+        entry: Optional[EventSyncEntry] = self.state.events.get(event.id)
+        if entry is None or event.updated_at is None or event.updated_at != entry.updated_at:
+            return None
+
+        return self.stored.get(event.id)
+
+    def record(self, instance: CalendarInstance) -> None:
+        if not instance.event or not instance.event.updated_at:
+            return
+
+        # the write workers finish the instances in any order, so keep the one that starts last to make the state
+        # stable between runs, it is also the instance that stays within the synced window the longest
+        latest: Optional[datetime] = self.starts_at.get(instance.event.id)
+        if latest is None or (instance.starts_at, instance.id) > (latest, self.synced[instance.event.id].instance_id):
+            self.starts_at[instance.event.id] = instance.starts_at
+            self.synced[instance.event.id] = EventSyncEntry(updated_at=instance.event.updated_at, instance_id=instance.id)
+
+    async def save(self) -> None:
+        if self.is_full_refresh:
+            self.state.full_refresh_at = datetime.now(tz=UTC)
+
+        self.state.events = dict(sorted(self.synced.items()))
+        await self.state_file.write_text(self.state.model_dump_json(indent=2))
+
+
+async def preload_event_connections(calendar: Calendar, concurrency: int) -> dict[str, list[EventConnection]]:
+    """
+    List the events with upcoming instances with their connections included, a handful of paged calls instead of
+    one lookup per event and without paging through years of past events. Events missing from the listing, such as
+    those whose instances in the window are all in the past, still have their connections looked up on their own,
+    and so does every event when the filter or the include is rejected.
+    """
+    event_connections: dict[str, list[EventConnection]] = {}
+
+    try:
+        event: ConnectedEvent
+        async for event in paginate(calendar.events_list, concurrency=concurrency):
+            # only trust events the connections were included for, an empty list is included as an empty list
+            if event.event_connections is not None:
+                event_connections[event.id] = event.event_connections
+    except HTTPErrorWrapper as e:
+        logger.warning(f"Listing the event connections failed, looking them up per event: {e}")
+        return {}
+
+    logger.info(f"Preloaded the connections of {len(event_connections)} events")
+    return event_connections
+
+
+def group_tag_values(data: list[GroupTag], group_tags: dict[str, GroupTagGroup]) -> dict[str, str]:
+    values: dict[str, str] = {}
+    for group_tag in data:
+        tag_group: GroupTagGroup = group_tags[group_tag.tag_group_id]
+        values[tag_group.name] = group_tag.value
+
+    return values
+
+
+async def preload_group_tags(groups: Groups, group_tags: dict[str, GroupTagGroup], concurrency: int) -> dict[str, dict[str, str]]:
+    """
+    List the groups with their tags included and index the tag values of every group by its id, so the group
+    connections become a lookup instead of a call each. Groups missing from the listing are looked up on their own.
+    """
+    group_tag_index: dict[str, dict[str, str]] = {}
+
+    try:
+        group: TaggedGroup
+        async for group in paginate(groups.groups_list, concurrency=concurrency):
+            if group.tags is not None:
+                group_tag_index[group.id] = group_tag_values(group.tags, group_tags)
+    except HTTPErrorWrapper as e:
+        logger.warning(f"Listing the group tags failed, looking them up per group: {e}")
+        return {}
+
+    logger.info(f"Preloaded the tags of {len(group_tag_index)} groups")
+    return group_tag_index
+
+
+def epoch(value: Optional[datetime]) -> Optional[int]:
+    return int(value.timestamp()) if value is not None else None
+
+
+class EventsIndex:
+    """
+    Collects the calendar instances into one compact file for the site build. The event, tags and registration
+    every recurrence repeats are stored once and referenced by id, and the dates are stored as epoch seconds.
+    """
+
+    def __init__(self):
+        self.events: dict[str, dict] = {}
+        self.tags: dict[str, dict] = {}
+        self.registrations: dict[str, dict] = {}
+        self.instances: list[dict] = []
+
+    def add(self, instance: CalendarInstance) -> None:
+        if instance.event:
+            event: dict = instance.event.model_dump(mode="json", exclude={"tags"})
+            event.update(created_at=epoch(instance.event.created_at), updated_at=epoch(instance.event.updated_at))
+            self.events[instance.event.id] = event
+
+        if instance.registration:
+            registration: dict = instance.registration.model_dump(mode="json")
+            registration.update(
+                open_at=epoch(instance.registration.open_at),
+                hide_at=epoch(instance.registration.hide_at),
+                show_at=epoch(instance.registration.show_at),
+            )
+            self.registrations[instance.registration.id] = registration
+
+        for tag in instance.tags or []:
+            self.tags[tag.id] = tag.model_dump(mode="json")
+
+        self.instances.append(
+            {
+                "id": instance.id,
+                "event_id": instance.event.id if instance.event else None,
+                "event_name": instance.event_name,
+                "status": instance.status,
+                "all_day_event": instance.all_day_event,
+                "event_featured": instance.event_featured,
+                "starts_at": epoch(instance.starts_at),
+                "ends_at": epoch(instance.ends_at),
+                "visible_starts_at": epoch(instance.visible_starts_at),
+                "visible_ends_at": epoch(instance.visible_ends_at),
+                "ministry": instance.ministry,
+                "color": instance.color,
+                "registration_id": instance.registration.id if instance.registration else None,
+                "tag_ids": [tag.id for tag in instance.tags or []],
+                "event_tags": instance.event_tags,
+                "group_tags": instance.group_tags,
+            }
+        )
+
+    def dump_json(self) -> str:
+        # the stages finish instances out of order so sort everything to keep the file stable between runs
+        index: dict = {
+            "events": dict(sorted(self.events.items())),
+            "tags": dict(sorted(self.tags.items())),
+            "registrations": dict(sorted(self.registrations.items())),
+            "instances": sorted(self.instances, key=lambda i: (i["starts_at"], i["id"])),
+        }
+        return dumps(index, separators=(",", ":"))
+
+
+async def lookup_connections(
+    instance: CalendarInstance,
+    calendar: Calendar,
+    groups: Groups,
+    registrations: Registrations,
+    group_tags: dict[str, GroupTagGroup],
+    event_connections: dict[str, list[EventConnection]],
+    group_tag_index: dict[str, dict[str, str]],
+) -> None:
+    # check for group connection
+    connections: Optional[list[EventConnection]] = event_connections.get(instance.event.id)
+    if connections is None:
+        connections = (await calendar.event_connections(instance.event.id)).data
+
+    for connection in connections:
+        match connection.connected_to_type:
+            case "group":
+                # get the group tags
+                values: Optional[dict[str, str]] = group_tag_index.get(str(connection.connected_to_id))
+                if values is None:
+                    values = group_tag_values((await groups.group_tags(connection.connected_to_id)).data, group_tags)
+
+                instance.group_tags.update(values)
+
+            case "signup":
+                # get the registration information to know if it is open
+                instance.registration = (await registrations.event(connection.connected_to_id)).data
+
+            case default:
+                ...
+
+
+async def enrich_instance(
+    instance: CalendarInstance,
+    calendar: Calendar,
+    groups: Groups,
+    registrations: Registrations,
+    group_tags: dict[str, GroupTagGroup],
+    event_connections: dict[str, list[EventConnection]],
+    group_tag_index: dict[str, dict[str, str]],
+    sync: EventSync,
+) -> CalendarInstance:
+    logger.info(f"{instance.visible_starts_at}: {instance.id} - {instance.event_name}")
+
+    # check for group connection
+    if instance.event:
+
+        # reuse the connections from the last run when the event has not been updated
+        stored: Optional[StoredEnrichment] = sync.enrichment(instance.event)
+        if stored is not None:
+            instance.group_tags.update(stored.group_tags)
+            instance.registration = stored.registration
+        else:
+            with metrics.phase("connections"):
+                await lookup_connections(instance, calendar, groups, registrations, group_tags, event_connections, group_tag_index)
+
+    # convert event tags into simple dictionary
+    if instance.tags:
+        for tag in instance.tags:
+            instance.event_tags[tag.group] = tag.name
+
+    # figure out what the ministry is
+    # 1. if group tag then use that
+    # 2. if tag has a ministry then use that
+    # 3. leave ministry blank if not found
+    if "Ministry" in instance.group_tags:
+        ministry = instance.group_tags["Ministry"]
+        if ministry in MINISTRY_GROUP_TAG_TO_SLUG:
+            instance.ministry = MINISTRY_GROUP_TAG_TO_SLUG[ministry]
+            instance.color = MINISTRY_COLOR[instance.ministry]
+
+    elif "Ministry" in instance.event_tags:
+        ministry = instance.event_tags["Ministry"]
+        if ministry in MINISTRY_TAG_TO_SLUG:
+            instance.ministry = MINISTRY_TAG_TO_SLUG[ministry]
+            instance.color = MINISTRY_COLOR[instance.ministry]
+
+    return instance
+
+
+async def download_instance_image(instance: CalendarInstance, client: AsyncClient, manifest: ImageManifest, images_dir: Path) -> CalendarInstance:
+    # keep track of the image urls and replace with the local cache path
+    if instance.event and instance.event.image_url:
+        with metrics.phase("download"):
+            image_name: Optional[str] = await download_image(client, manifest, images_dir, instance.event.image_url)
+
+        # an image that could not be downloaded is left pointing at planning center
+        if image_name is not None:
+            instance.event.image_url = f"~/assets/images/{image_name}"
+
+    return instance
+
+
+async def write_instance(instance: CalendarInstance, writer: DataWriter, sync: EventSync, index: Optional[EventsIndex]) -> None:
+    with metrics.phase("write"):
+        await writer.write_model(f"{instance.id}.json", instance)
+
+    if index is not None:
+        index.add(instance)
+
+    sync.record(instance)
+
+
+async def stage_worker(receive_stream: MemoryObjectReceiveStream, send_stream: Optional[MemoryObjectSendStream], stage: Callable, *args) -> None:
+    """
+    Pass every item of the receive stream through the stage and send the result on to the next stage. The send
+    stream is closed once the receive stream is exhausted, so the next stage ends after the last worker of this one.
+    """
+    async with receive_stream:
+        async for item in receive_stream:
+            result = await stage(item, *args)
+            if send_stream is not None:
+                await send_stream.send(result)
+
+    if send_stream is not None:
+        await send_stream.aclose()
 
 
 def parse_args():
@@ -109,6 +435,16 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument("--data-dir", type=str, required=True)
     parser.add_argument("--assets-dir", type=str, required=True)
+    parser.add_argument("--workers", type=int, default=8, help="number of calendar instances enriched concurrently")
+    parser.add_argument("--download-workers", type=int, default=8, help="number of event images downloaded concurrently")
+    parser.add_argument("--write-workers", type=int, default=4, help="number of event files written concurrently")
+    parser.add_argument("--full-refresh-hours", type=float, default=24, help="hours between lookups of the connections of unchanged events")
+    parser.add_argument("--page-concurrency", type=int, default=4, help="number of listing pages requested concurrently")
+    parser.add_argument("--compact-json", action="store_true", help="write the event files without indentation")
+    parser.add_argument("--events-index", action="store_true", help="also write a compact index of all the events to events-index.json")
+    parser.add_argument("--metrics-file", type=str, help="write the metrics summary of the run to this json file")
+    add_cassette_arguments(parser)
+    add_derivative_arguments(parser)
     return parser.parse_args()
 
 
@@ -116,7 +452,7 @@ async def main():
     CLIENT_ID: str = environ.get("PLANNINGCENTER_CLIENT_ID")
     CLIENT_SECRET: str = environ.get("PLANNINGCENTER_SECRET")
 
-    auth: BasicAuth = BasicAuth(CLIENT_ID, CLIENT_SECRET)
+    auth: Optional[Auth] = planningcenter_auth(CLIENT_ID, CLIENT_SECRET)
 
     args: Namespace = parse_args()
 
@@ -129,90 +465,109 @@ async def main():
     data_dir: Path = Path(args.data_dir)
     await data_dir.mkdir(parents=True, exist_ok=True)
 
-    # always cleanup the event dir
-    events_dir = Path(data_dir) / "events"
-    rmtree(str(events_dir), ignore_errors=True)
-    await events_dir.mkdir(parents=True, exist_ok=True)
+    # only rewrite the events that changed and remove the ones that are gone once the run completes
+    writer: DataWriter = DataWriter(data_dir / "events", compact=args.compact_json)
+
+    # skip the connection lookups of events that have not been updated since the last run
+    sync: EventSync = EventSync(data_dir / ".events-sync.json", timedelta(hours=args.full_refresh_hours))
+
+    # collect the instances into a single compact file next to the per instance files
+    index: Optional[EventsIndex] = EventsIndex() if args.events_index else None
+
+    with metrics.phase("load"):
+        await writer.start()
+        await sync.load(writer.data_dir)
 
     # get the asset dir and make sure it exists
     assets_dir: Path = Path(args.assets_dir)
     await assets_dir.mkdir(parents=True, exist_ok=True)
     images_dir = assets_dir / "images"
-
-    # always cleanup the event images
-    async for image_file in images_dir.glob("events-*.*"):
-        await image_file.unlink()
-
-    # get the group tag groups
-    groups = Groups(auth=auth)
-    group_tags: dict[str, GroupTagGroup] = {}
-    async for tag_isntance in paginate(groups.tag_groups):
-        tag_group: GroupTagGroup = GroupTagGroup(**tag_isntance)
-        logger.trace(f"Tag Group: {tag_group.id} - {tag_group.name}")
-        group_tags[tag_group.id] = tag_group
-
-    # get the registrations class
-    registrations = Registrations(auth=auth)
-
-    calendar = Calendar(auth=auth)
-    async for raw_instance in paginate(calendar.calendar_instances_list, during_start, during_end):
-        instance: CalendarInstance = CalendarInstance(**raw_instance)
-        logger.info(f"{instance.visible_starts_at}: {instance.id} - {instance.event_name}")
-
-        # check for group connection and image
-        if instance.event:
-
-            # keep track of the image urls and replace with the local cache path
-            if instance.event.image_url:
-                image_name: str = await download_image(images_dir, instance.event.image_url)
-                instance.event.image_url = f"~/assets/images/{image_name}"
-
-            # check for group connection
-            data = (await calendar.event_connections(instance.event.id))["data"]
-            connections: list[EventConnection] = [EventConnection(**ec) for ec in data]
-
-            for connection in connections:
-                match connection.connected_to_type:
-                    case "group":
-                        # get the group tags
-                        data = (await groups.group_tags(connection.connected_to_id))["data"]
-                        for d in data:
-                            group_tag: GroupTag = GroupTag(**d)
-                            tag_group: GroupTagGroup = group_tags[group_tag.tag_group_id]
-                            instance.group_tags[tag_group.name] = group_tag.value
-
-                    case "signup":
-                        # get the registration information to know if it is open
-                        data = (await registrations.event(connection.connected_to_id))["data"]
-                        instance.registration = RegistrationEvent(**data)
-
-                    case default:
-                        ...
-
-        # convert event tags into simple dictionary
-        if instance.tags:
-            for tag in instance.tags:
-                instance.event_tags[tag.group] = tag.name
-
-        # figure out what the ministry is
-        # 1. if group tag then use that
-        # 2. if tag has a ministry then use that
-        # 3. leave ministry blank if not found
-        if "Ministry" in instance.group_tags:
-            ministry = instance.group_tags["Ministry"]
-            if ministry in MINISTRY_GROUP_TAG_TO_SLUG:
-                instance.ministry = MINISTRY_GROUP_TAG_TO_SLUG[ministry]
-                instance.color = MINISTRY_COLOR[instance.ministry]
-
-        elif "Ministry" in instance.event_tags:
-            ministry = instance.event_tags["Ministry"]
-            if ministry in MINISTRY_TAG_TO_SLUG:
-                instance.ministry = MINISTRY_TAG_TO_SLUG[ministry]
-                instance.color = MINISTRY_COLOR[instance.ministry]
-
-        event_file: Path = events_dir / f"{instance.id}.json"
-        await event_file.write_text(instance.model_dump_json(indent=2))
-
+    await images_dir.mkdir(parents=True, exist_ok=True)
+
+    # keep the event images from the last run so unchanged ones are only revalidated
+    store: BlobStore = BlobStore(assets_dir / ".blobs")
+    manifest: ImageManifest = ImageManifest(images_dir, "events", store, derivatives_from_args(args))
+
+    # share one pooled client between the api calls and the image downloads
+    async with create_client(auth, cassette=cassette_from_args(args)) as client:
+        # get the group tag groups
+        groups = Groups(client)
+        group_tags: dict[str, GroupTagGroup] = {}
+        with metrics.phase("tag_groups"):
+            tag_group: GroupTagGroup
+            async for tag_group in paginate(groups.tag_groups, concurrency=args.page_concurrency):
+                logger.trace(f"Tag Group: {tag_group.id} - {tag_group.name}")
+                group_tags[tag_group.id] = tag_group
+
+        # get the registrations class
+        registrations = Registrations(client)
+
+        # the calendar instances flow through the fetch, enrich, download and write stages each with their own workers,
+        # the fetch buffer holds a page so the next page is requested while the previous one is still being worked on
+        calendar = Calendar(client)
+
+        # a full refresh looks up the connections of every event so list them and the group tags all up front,
+        # otherwise only the events updated since the last run are looked up and those are left to the per event lookups
+        event_connections: dict[str, list[EventConnection]] = {}
+        group_tag_index: dict[str, dict[str, str]] = {}
+        if sync.is_full_refresh:
+            with metrics.phase("event_connections"):
+                event_connections = await preload_event_connections(calendar, args.page_concurrency)
+
+            with metrics.phase("group_tags"):
+                group_tag_index = await preload_group_tags(groups, group_tags, args.page_concurrency)
+
+        enrich_send, enrich_receive = create_memory_object_stream[CalendarInstance](PAGE_SIZE)
+        download_send, download_receive = create_memory_object_stream[CalendarInstance](args.download_workers)
+        write_send, write_receive = create_memory_object_stream[CalendarInstance](args.write_workers)
+
+        with metrics.phase("calendar"):
+            async with create_task_group() as tg:
+                async with enrich_receive, download_send:
+                    for _ in range(args.workers):
+                        tg.start_soon(
+                            stage_worker,
+                            enrich_receive.clone(),
+                            download_send.clone(),
+                            enrich_instance,
+                            calendar,
+                            groups,
+                            registrations,
+                            group_tags,
+                            event_connections,
+                            group_tag_index,
+                            sync,
+                        )
+
+                async with download_receive, write_send:
+                    for _ in range(args.download_workers):
+                        tg.start_soon(stage_worker, download_receive.clone(), write_send.clone(), download_instance_image, client, manifest, images_dir)
+
+                async with write_receive:
+                    for _ in range(args.write_workers):
+                        tg.start_soon(stage_worker, write_receive.clone(), None, write_instance, writer, sync, index)
+
+                async with enrich_send:
+                    pages = paginate(calendar.calendar_instances_list, during_start, during_end, per_page=PAGE_SIZE, concurrency=args.page_concurrency)
+                    async for instance in pages:
+                        await enrich_send.send(instance)
+
+    # remove the events and event images that are no longer referenced
+    with metrics.phase("finish"):
+        await writer.finish()
+
+        if index is not None:
+            index_writer: DataWriter = DataWriter(data_dir, "events-index.json")
+            await index_writer.start()
+            await index_writer.write("events-index.json", index.dump_json())
+            await index_writer.finish()
+
+        await manifest.prune("events-*.*")
+        manifest.save()
+        store.prune()
+        await sync.save()
+
+    metrics.report(args.metrics_file)
     logger.success("Done")
 
 
@@ -1,16 +1,23 @@
 from argparse import ArgumentParser, Namespace
+from hashlib import sha256
+from importlib.metadata import version
 from os import environ
-from re import compile, Pattern
 from shutil import rmtree
 from typing import Optional
 from urllib.parse import urlparse, ParseResult
 
-from anyio import run, Path
+from anyio import create_task_group, run, CapacityLimiter, Path
 from dotenv import load_dotenv
-from httpx import BasicAuth, AsyncClient
+from httpx import AsyncClient, HTTPStatusError, TransportError
 from loguru import logger
-from markdownify import MarkdownConverter, re_all_whitespace
-
+from markdownify import chomp, MarkdownConverter, re_all_whitespace
+from pydantic import BaseModel, Field
+
+from http_cassette import add_cassette_arguments, cassette_from_args
+from http_client import create_client, planningcenter_auth
+from image_derivatives import add_derivative_arguments, derivatives_from_args
+from image_manifest import BlobStore, ImageManifest
+from metrics import metrics
 from planningcenter_api import (
     paginate,
     Publishing,
@@ -39,10 +46,11 @@ CC_TO_SITE_SLUGS: dict[str, str] = {
 }
 
 
-async def download_images(page: PageInstance, images_dir: Path) -> tuple[Optional[str], dict[str, str]]:
+def collect_images(page: PageInstance, images_dir: Path, manifest: ImageManifest) -> tuple[Optional[str], dict[str, str], list[tuple[str, Path]]]:
     slug: str = CC_TO_SITE_SLUGS[page.attr.slug]
     first: Optional[str] = None
     images: dict[str, str] = {}
+    downloads: list[tuple[str, Path]] = []
 
     # look through all the blocks
     for block in page.attr.blocks:
@@ -56,15 +64,9 @@ async def download_images(page: PageInstance, images_dir: Path) -> tuple[Optiona
 
                     url: ParseResult = urlparse(item.src)
                     suffix: str = Path(url.path).suffix.lower()
-                    image_file: Path = images_dir / f"ministry-{slug}-{block.id}-{i}{suffix}"
-                    images[block.id] = image_file.name
-
-                    # download all the images from each page
-                    async with AsyncClient() as client:
-                        async with client.stream("GET", item.src) as response:
-                            async with await image_file.open("wb") as f:
-                                async for chunk in response.aiter_bytes():
-                                    await f.write(chunk)
+                    image_file: Path = manifest.site_file(images_dir / f"ministry-{slug}-{block.id}-{i}{suffix}")
+                    images[f"{block.id}-{i}"] = image_file.name
+                    downloads.append((item.src, image_file))
 
             case ImageBlock():
                 if not first:
@@ -72,15 +74,9 @@ async def download_images(page: PageInstance, images_dir: Path) -> tuple[Optiona
 
                 # make image file path
                 suffix: str = Path(block.alt).suffix.lower()
-                image_file: Path = images_dir / f"ministry-{slug}-{block.id}{suffix}"
+                image_file: Path = manifest.site_file(images_dir / f"ministry-{slug}-{block.id}{suffix}")
                 images[block.id] = image_file.name
-
-                # download all the images from each page
-                async with AsyncClient() as client:
-                    async with client.stream("GET", block.src) as response:
-                        async with await image_file.open("wb") as f:
-                            async for chunk in response.aiter_bytes():
-                                await f.write(chunk)
+                downloads.append((block.src, image_file))
 
             case SectionHeaderBlock():
                 # check if there is an image in the section header
@@ -90,25 +86,45 @@ async def download_images(page: PageInstance, images_dir: Path) -> tuple[Optiona
 
                     url: ParseResult = urlparse(block.background_image_url)
                     suffix: str = Path(url.path).suffix.lower()
-                    image_file: Path = images_dir / f"ministry-{slug}-{block.id}{suffix}"
+                    image_file: Path = manifest.site_file(images_dir / f"ministry-{slug}-{block.id}{suffix}")
                     images[block.id] = image_file.name
+                    downloads.append((block.background_image_url, image_file))
 
-                    # download all the images from each page
-                    async with AsyncClient() as client:
-                        async with client.stream("GET", block.background_image_url) as response:
-                            async with await image_file.open("wb") as f:
-                                async for chunk in response.aiter_bytes():
-                                    await f.write(chunk)
+    # return the first image id, the image file names by block id, or block id and index for grid items, and the
+    # files to download them to
+    return first, images, downloads
 
-    # return the first image id and all the images by id
-    return first, images
 
+async def download_image(
+    client: AsyncClient,
+    manifest: ImageManifest,
+    limiter: CapacityLimiter,
+    url: str,
+    image_files: list[Path],
+    missing: dict[str, str],
+) -> None:
+    # download the url once into the first file and link it under the other names it is used under
+    async with limiter:
+        with metrics.phase("download"):
+            try:
+                await manifest.download(client, url, image_files[0])
+            except (HTTPStatusError, TransportError) as e:
+                # without a file from the last run the pages link the image from planning center instead
+                if manifest.failed(url, e, image_files[0]) is None:
+                    missing.update({image_file.name: url for image_file in image_files})
+                    return
 
-async def geneate_excerpt(markdown: str) -> str:
-    return f"{markdown[0:100]}..."
+    for image_file in image_files[1:]:
+        manifest.link(url, image_file)
 
 
-MD_LINK: Pattern = compile(r"\[(?P<text>[^\]]+)\]\((?P<src>[^\)]+)\)")
+def image_sources(images: dict[str, str], missing: dict[str, str]) -> dict[str, str]:
+    # the site asset of every image, or its remote url when it could not be downloaded
+    return {key: missing.get(name, f"~/assets/images/{name}") for key, name in images.items()}
+
+
+async def geneate_excerpt(markdown: str) -> str:
+    return f"{markdown[0:100]}..."
 
 
 class BlankTargetLinkConverter(MarkdownConverter):
@@ -117,13 +133,16 @@ class BlankTargetLinkConverter(MarkdownConverter):
     """
 
     def convert_a(self, el, text, parent_tags):
-        md_link: str = super().convert_a(el, text, parent_tags)
-        m = MD_LINK.match(md_link)
-        if m:
-            g = m.groupdict()
-            return f'<a href="{g["src"]}" target="_blank">{g["text"]}</a>'
-        else:
-            return f"{md_link}"
+        if "_noformat" in parent_tags:
+            return text
+
+        # emit the anchor straight from the element instead of parsing it back out of the markdown link
+        prefix, suffix, text = chomp(text)
+        href: Optional[str] = el.get("href")
+        if not text or not href:
+            return text
+
+        return f'{prefix}<a href="{href}" target="_blank">{text}</a>{suffix}'
 
     def _convert_hn(self, n, el, text, parent_tags):
         """Method name prefixed with _ to prevent <hn> to call this"""
@@ -142,15 +161,61 @@ class BlankTargetLinkConverter(MarkdownConverter):
         return "\n\n%s %s\n\n" % (hashes, text)
 
 
+# the converter holds no state between conversions so a single one converts every block
+CONVERTER: BlankTargetLinkConverter = BlankTargetLinkConverter()
+
+# part of the cache key so a change to the converter, or an upgrade of markdownify, converts every block again
+CONVERTER_VERSION: str = f"1-markdownify-{version('markdownify')}"
+
+
 # Create shorthand method for conversion
-def md(html, **options):
-    return BlankTargetLinkConverter(**options).convert(html)
+def md(html: str) -> str:
+    return CONVERTER.convert(html)
+
 
+class MarkdownCacheState(BaseModel):
+    version: str = CONVERTER_VERSION
+    blocks: dict[str, str] = Field(default_factory=dict)
 
-async def convert_content(page: PageInstance) -> tuple[str, str]:
+
+class MarkdownCache:
+    """
+    Keeps the markdown of the text blocks from the last run by the sha256 of their html, so only the blocks that
+    changed since then are converted again. Blocks that were not seen during the run drop out when it is saved.
+    """
+
+    def __init__(self, cache_file: Path):
+        self.cache_file: Path = cache_file
+        self.blocks: dict[str, str] = {}
+        self.used: dict[str, str] = {}
+        self.hits: int = 0
+
+    async def load(self) -> None:
+        if await self.cache_file.exists():
+            state: MarkdownCacheState = MarkdownCacheState.model_validate_json(await self.cache_file.read_bytes())
+            if state.version == CONVERTER_VERSION:
+                self.blocks = state.blocks
+
+    def convert(self, html: str) -> str:
+        key: str = sha256(html.encode()).hexdigest()
+        markdown: Optional[str] = self.blocks.get(key)
+        if markdown is None:
+            markdown = md(html)
+        else:
+            self.hits += 1
+
+        self.used[key] = markdown
+        return markdown
+
+    async def save(self) -> None:
+        state: MarkdownCacheState = MarkdownCacheState(blocks=dict(sorted(self.used.items())))
+        await self.cache_file.write_text(state.model_dump_json(indent=2))
+        logger.info(f"markdown: {self.hits} of {len(self.used)} text blocks unchanged")
+
+
+async def convert_content(page: PageInstance, images: dict[str, str], cache: MarkdownCache) -> tuple[str, str]:
     content: list[str] = []
     excerpt: Optional[str] = None
-    slug: str = CC_TO_SITE_SLUGS[page.attr.slug]
 
     # iterate blocks and render content
     for block in page.attr.blocks:
@@ -174,11 +239,8 @@ async def convert_content(page: PageInstance) -> tuple[str, str]:
                     item_content: dict[str, str] = {}
 
                     # image
-                    url: ParseResult = urlparse(item.src)
-                    suffix: str = Path(url.path).suffix.lower()
-
                     if item.src:
-                        item_content["imageUrl"] = f"~/assets/images/ministry-{slug}-{block.id}-{i}{suffix}"
+                        item_content["imageUrl"] = images[f"{block.id}-{i}"]
 
                     # link
                     if item.link_url:
@@ -207,7 +269,7 @@ async def convert_content(page: PageInstance) -> tuple[str, str]:
 
             case ImageBlock():
                 alt: Path = Path(block.alt)
-                content.append(f"![{alt.name.lower()}](~/assets/images/ministry-{slug}-{block.id}{alt.suffix.lower()})")
+                content.append(f"![{alt.name.lower()}]({images[block.id]})")
 
             case SectionHeaderBlock():
                 # insert text
@@ -217,11 +279,8 @@ async def convert_content(page: PageInstance) -> tuple[str, str]:
 
                 # insert image
                 if block.background_image_enabled:
-                    url: ParseResult = urlparse(block.background_image_url)
-                    suffix: str = Path(url.path).suffix.lower()
-
                     content.append(
-                        f'<Image src="~/assets/images/ministry-{slug}-{block.id}{suffix}" '
+                        f'<Image src="{images[block.id]}" '
                         'class="w-full h-40 rounded shadow-lg bg-gray-400 dark:bg-slate-700" '
                         'widths={[400, 900]} width={400} sizes="(max-width: 900px) 400px, 900px" '
                         'alt="background" aspectRatio="16:9" layout="cover" '
@@ -229,7 +288,7 @@ async def convert_content(page: PageInstance) -> tuple[str, str]:
                     )
 
             case TextBlock():
-                markdown: str = md(block.content)
+                markdown: str = cache.convert(block.content)
                 content.append(f"{markdown}")
 
                 if excerpt is None:
@@ -248,35 +307,35 @@ async def convert_content(page: PageInstance) -> tuple[str, str]:
     return excerpt.replace("\n", "").replace("*", "").replace('"', ""), combined
 
 
-async def model_to_markdown(page: PageInstance, ministries_dir: Path, images_dir: Path):
-    # fetch the header image from church center and store it locally all other images will be left on church center
-    first_id, images = await download_images(page, images_dir)
-    excerpt, content = await convert_content(page)
+async def model_to_markdown(page: PageInstance, images: dict[str, str], image: str, ministries_dir: Path, cache: MarkdownCache):
+    with metrics.phase("convert"):
+        excerpt, content = await convert_content(page, images, cache)
 
     # compute the minstry markdown file name
     ministry_file: Path = ministries_dir / f"{CC_TO_SITE_SLUGS[page.attr.slug]}.mdx"
-    async with await ministry_file.open("w") as f:
-        # write the header
-        await f.writelines(
-            [
-                "---\n",
-                f'title: "{page.attr.title}"\n',
-                f'excerpt: "{excerpt}"\n',
-                f'image: "~/assets/images/{images[first_id]}"\n',
-                "---\n",
-                "\n",
-                "import Image from '~/components/common/Image.astro';\n",
-                "import BlockGrid from '~/components/ministries/BlockGrid.astro';\n",
-                # "import Button from '~/components/ui/Button.astro';\n",
-                "\n",
-            ]
-        )
-
-        # write the content
-        await f.write(content)
-
-        # make sure we flush the data to the file
-        await f.flush()
+    with metrics.phase("write"):
+        async with await ministry_file.open("w") as f:
+            # write the header
+            await f.writelines(
+                [
+                    "---\n",
+                    f'title: "{page.attr.title}"\n',
+                    f'excerpt: "{excerpt}"\n',
+                    f'image: "{image}"\n',
+                    "---\n",
+                    "\n",
+                    "import Image from '~/components/common/Image.astro';\n",
+                    "import BlockGrid from '~/components/ministries/BlockGrid.astro';\n",
+                    # "import Button from '~/components/ui/Button.astro';\n",
+                    "\n",
+                ]
+            )
+
+            # write the content
+            await f.write(content)
+
+            # make sure we flush the data to the file
+            await f.flush()
 
 
 def parse_args():
@@ -290,6 +349,11 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument("--data-dir", type=str, required=True)
     parser.add_argument("--assets-dir", type=str, required=True)
+    parser.add_argument("--page-concurrency", type=int, default=4, help="number of listing pages requested concurrently")
+    parser.add_argument("--download-workers", type=int, default=8, help="number of images downloaded concurrently")
+    parser.add_argument("--metrics-file", type=str, help="write the metrics summary of the run to this json file")
+    add_cassette_arguments(parser)
+    add_derivative_arguments(parser)
     return parser.parse_args()
 
 
@@ -312,25 +376,64 @@ async def main():
     assets_dir: Path = Path(args.assets_dir)
     await assets_dir.mkdir(parents=True, exist_ok=True)
     images_dir = assets_dir / "images"
-
-    # always cleanup the ministries images to remove old ministries
-    async for image_file in images_dir.glob("ministry-*.*"):
-        await image_file.unlink()
-
-    # fetch the content and images from church center
-    publishing = Publishing(auth=BasicAuth(CLIENT_ID, CLIENT_SECRET))
-
-    async for instance in paginate(publishing.pages_list):
-        if instance["attributes"]["slug"] not in CC_TO_SITE_SLUGS:
-            continue
-
-        # convert from rest json to model
-        page: PageInstance = PageInstance(**instance)
-        logger.debug(f"{page.attr.slug}: {page.id} - {page.attr.title}")
-
-        # convert from model to markdown
-        await model_to_markdown(page, ministries_dir, images_dir)
-
+    await images_dir.mkdir(parents=True, exist_ok=True)
+
+    # keep the ministries images from the last run so unchanged ones are only revalidated
+    store: BlobStore = BlobStore(assets_dir / ".blobs")
+    manifest: ImageManifest = ImageManifest(images_dir, "ministry", store, derivatives_from_args(args))
+
+    # the markdown of the text blocks from the last run, the ministries dir itself is rebuilt every run
+    cache: MarkdownCache = MarkdownCache(data_dir / ".ministries-markdown.json")
+    await cache.load()
+
+    # share one pooled client between the api calls and the image downloads
+    async with create_client(planningcenter_auth(CLIENT_ID, CLIENT_SECRET), cassette=cassette_from_args(args)) as client:
+        # fetch the content and images from church center
+        publishing = Publishing(client)
+
+        pages: list[PageInstance] = []
+        async for instance in paginate(publishing.pages_list, concurrency=args.page_concurrency):
+            if instance["attributes"]["slug"] not in CC_TO_SITE_SLUGS:
+                continue
+
+            # convert from rest json to model
+            page: PageInstance = PageInstance(**instance)
+            logger.debug(f"{page.attr.slug}: {page.id} - {page.attr.title}")
+            pages.append(page)
+
+        # collect the images of every page up front so each url is downloaded once however many blocks use it, the
+        # blob store then also keeps a picture uploaded under several urls once
+        downloads: dict[str, list[Path]] = {}
+        page_images: list[tuple[PageInstance, dict[str, str], str]] = []
+        for page in pages:
+            first_id, images, page_downloads = collect_images(page, images_dir, manifest)
+            page_images.append((page, images, first_id))
+
+            for url, image_file in page_downloads:
+                if image_file not in downloads.setdefault(url, []):
+                    downloads[url].append(image_file)
+
+        # download the images with a bounded pool before the pages are converted to markdown, so an image that
+        # could not be downloaded is linked from planning center instead of from a missing asset
+        missing: dict[str, str] = {}
+        limiter: CapacityLimiter = CapacityLimiter(args.download_workers)
+        async with create_task_group() as tg:
+            for url, image_files in downloads.items():
+                tg.start_soon(download_image, client, manifest, limiter, url, image_files, missing)
+
+        async with create_task_group() as tg:
+            for page, images, first_id in page_images:
+                sources: dict[str, str] = image_sources(images, missing)
+                tg.start_soon(model_to_markdown, page, sources, sources[first_id], ministries_dir, cache)
+
+    # remove the images of old ministries
+    with metrics.phase("finish"):
+        await manifest.prune("ministry-*.*")
+        manifest.save()
+        store.prune()
+        await cache.save()
+
+    metrics.report(args.metrics_file)
     logger.success("Done")
 
 
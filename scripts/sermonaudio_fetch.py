@@ -1,16 +1,30 @@
 from argparse import ArgumentParser, Namespace
-from pathlib import Path
+from datetime import datetime, timedelta, UTC
+from functools import partial
+from math import ceil
 from os import environ
+from time import perf_counter
+from typing import AsyncIterator, Callable, Optional
 
+from anyio import create_task_group, run, to_thread, CapacityLimiter, Path
 from dotenv import load_dotenv
-from httpx import get
+from httpx import AsyncClient, HTTPStatusError, TransportError
 from loguru import logger
-from sermonaudio import set_api_key
+from pydantic import BaseModel
+from sermonaudio import _session, set_api_key
 from sermonaudio.models import SeriesSortOrder, SermonSortOption
 from sermonaudio.node.requests import Node
 
+from data_writer import DataWriter
+from http_cassette import add_cassette_arguments, cassette_from_args, Cassette
+from http_client import create_client
+from image_derivatives import add_derivative_arguments, derivatives_from_args, Derivatives
+from image_manifest import BlobStore, ImageManifest
+from metrics import metrics
 from sermonaudio_models import Series, Sermon, Speaker
 
+PAGE_SIZE: int = 100
+
 
 def parse_args():
     """
@@ -22,81 +36,177 @@ def parse_args():
 
     parser = ArgumentParser()
     parser.add_argument("--data-dir", type=str, required=True)
+    parser.add_argument("--full-reconcile-hours", type=float, default=24, help="hours between syncs that page through every sermon")
+    parser.add_argument("--page-concurrency", type=int, default=4, help="number of listing pages requested concurrently")
+    parser.add_argument("--thumbnail-concurrency", type=int, default=8, help="number of thumbnails downloaded concurrently")
+    parser.add_argument("--compact-json", action="store_true", help="write the sermon, series and speaker files without indentation")
+    parser.add_argument("--metrics-file", type=str, help="write the metrics summary of the run to this json file")
+    add_cassette_arguments(parser)
+    # the site looks the thumbnails up as sermons/<id>.jpg so they are only scaled down, never transcoded
+    add_derivative_arguments(parser, transcode=False)
     return parser.parse_args()
 
 
-def fetch_sermons(sermons_dir: Path, thumbs_dir: Path) -> None:
-    sermons_dir.mkdir(parents=True, exist_ok=True)
-    thumbs_dir.mkdir(parents=True, exist_ok=True)
+async def call_node(method: Callable, **kwargs):
+    # the SDK is synchronous so call it in a worker thread
+    start: float = perf_counter()
+    try:
+        return await to_thread.run_sync(partial(method, **kwargs))
+    finally:
+        metrics.call(f"Node.{method.__name__}", perf_counter() - start)
+
+
+async def get_pages(method: Callable, concurrency: int, **kwargs) -> AsyncIterator[list]:
+    """
+    Iterate the pages of a paged sermonaudio listing. The SDK is synchronous so each page is requested in a worker
+    thread, the first page tells us the total count and the remaining pages are then requested concurrently.
+    """
+    paged = await call_node(method, page=1, page_size=PAGE_SIZE, **kwargs)
+    yield paged.results
+
+    pages: list[int] = list(range(2, ceil(paged.total_count / PAGE_SIZE) + 1))
+
+    for i in range(0, len(pages), concurrency):
+        results: dict[int, list] = {}
+
+        async def fetch_page(page: int):
+            results[page] = (await call_node(method, page=page, page_size=PAGE_SIZE, **kwargs)).results
+
+        # fetch the window of pages concurrently and yield outside the task group so the pages stay in order
+        async with create_task_group() as tg:
+            for page in pages[i : i + concurrency]:
+                tg.start_soon(fetch_page, page)
+
+        for page in pages[i : i + concurrency]:
+            yield results[page]
+
+
+async def download_thumbnail(client: AsyncClient, manifest: ImageManifest, limiter: CapacityLimiter, url: str, thumbnail_file: Path) -> None:
+    async with limiter:
+        with metrics.phase("download"):
+            try:
+                await manifest.download(client, url, thumbnail_file)
+            except (HTTPStatusError, TransportError) as e:
+                manifest.failed(url, e, thumbnail_file)
+
+
+class SermonSyncState(BaseModel):
+    full_reconcile_at: Optional[datetime] = None
+
+
+async def fetch_sermons(
+    client: AsyncClient,
+    sermons_dir: Path,
+    thumbs_dir: Path,
+    store: BlobStore,
+    derivatives: Optional[Derivatives],
+    state_file: Path,
+    full_reconcile: timedelta,
+    page_concurrency: int,
+    thumbnail_concurrency: int,
+    compact: bool,
+) -> None:
+    writer: DataWriter = DataWriter(sermons_dir, compact=compact)
+    await writer.start()
+    await thumbs_dir.mkdir(parents=True, exist_ok=True)
+    manifest: ImageManifest = ImageManifest(thumbs_dir, "sermons", store, derivatives)
+    limiter: CapacityLimiter = CapacityLimiter(thumbnail_concurrency)
+
+    # sermons come newest published first, so unless a full reconcile is due to pick up deleted and older edited
+    # sermons stop paging once a page reaches a sermon that is already on disk unchanged
+    state: SermonSyncState = SermonSyncState()
+    if await state_file.exists():
+        state = SermonSyncState.model_validate_json(await state_file.read_text())
+
+    now: datetime = datetime.now(tz=UTC)
+    is_full_reconcile: bool = state.full_reconcile_at is None or now - state.full_reconcile_at >= full_reconcile
+    if not is_full_reconcile:
+        page_concurrency = 1
 
-    page: int = 0
     total: int = 0
-    while page == 0 or total < paged.total_count:
-        page += 1
-        paged = Node.get_sermons(
-            broadcaster_id="phcc",
-            page=page,
-            page_size=100,
-            sort_by=SermonSortOption.NEWEST_PUBLISHED,
-        )
-        total += len(paged.results)
 
-        # conver the results to sermons
-        for result in paged.results:
-            sermon: Sermon = Sermon(**result._Model__obj)
+    # the thumbnails download in the background while the next pages of sermons are fetched
+    async with create_task_group() as tg:
+        pages = get_pages(Node.get_sermons, page_concurrency, broadcaster_id="phcc", sort_by=SermonSortOption.NEWEST_PUBLISHED)
+        async for results in pages:
+            total += len(results)
+            caught_up: bool = False
+
+            # conver the results to sermons, ensuring video exists before adding them
+            sermons: dict[str, Sermon] = {}
+            for result in results:
+                sermon: Sermon = Sermon(**result._Model__obj)
+                if sermon.hasVideo:
+                    sermons[f"{sermon.id}.json"] = sermon
+                    logger.debug(f"{sermon.id} - {sermon.displayTitle}")
+
+                    # download the thumbnail as sermon audio seems to have issues with these now
+                    thumbnail_file: Path = thumbs_dir / f"{sermon.id}.jpg"
+                    tg.start_soon(download_thumbnail, client, manifest, limiter, str(sermon.media.video[0].thumbnailImageURL), thumbnail_file)
 
-            # ensure video exists before adding it
-            if sermon.hasVideo:
-                sermon_file: Path = sermons_dir / f"{sermon.id}.json"
-                sermon_file.write_text(sermon.model_dump_json(indent=2, exclude_none=True, exclude_unset=True))
-                logger.debug(f"{sermon.id} - {sermon.displayTitle}")
+            # write the whole page in one batch
+            with metrics.phase("write"):
+                changed: dict[str, bool] = await writer.write_models(sermons, exclude_none=True, exclude_unset=True)
+            caught_up = not all(changed.values())
 
-                # download the thumbnail as sermon audio seems to have issues with these now
-                thumbnail_file: Path = thumbs_dir / f"{sermon.id}.jpg"
+            if caught_up and not is_full_reconcile:
+                logger.info("Reached sermons that are already up to date")
+                break
 
-                if not thumbnail_file.exists():
-                    resp = get(str(sermon.media.video[0].thumbnailImageURL))
-                    thumbnail_file.write_bytes(resp.read())
+    with metrics.phase("finish"):
+        await writer.finish(prune=is_full_reconcile)
+
+        # only a full reconcile has seen every sermon, so only then are the thumbnails of removed sermons deleted
+        if is_full_reconcile:
+            await manifest.prune("*.*")
+        manifest.save(prune=is_full_reconcile)
+        store.prune()
+
+        if is_full_reconcile:
+            state.full_reconcile_at = now
+            await state_file.write_text(state.model_dump_json(indent=2))
 
     logger.info(f"fetched {total} sermons")
 
 
-def fetch_series(series_dir: Path) -> None:
-    series_dir.mkdir(parents=True, exist_ok=True)
+async def fetch_series(series_dir: Path, page_concurrency: int, compact: bool) -> None:
+    writer: DataWriter = DataWriter(series_dir, compact=compact)
+    await writer.start()
 
-    page: int = 0
     total: int = 0
-    while page == 0 or total < paged.total_count:
-        page += 1
-        paged = Node.get_series_list(
-            broadcaster_id="phcc",
-            page=page,
-            page_size=100,
-            sort_by=SeriesSortOrder.NEWEST_SERMON_CREATE_DATE,
-        )
-        total += len(paged.results)
+    pages = get_pages(Node.get_series_list, page_concurrency, broadcaster_id="phcc", sort_by=SeriesSortOrder.NEWEST_SERMON_CREATE_DATE)
+    async for results in pages:
+        total += len(results)
 
         # conver the results to series
-        for result in paged.results:
+        series_list: dict[str, Series] = {}
+        for result in results:
             series: Series = Series(**result._Model__obj)
-            series_file: Path = series_dir / f"{series.id}.json"
-            series_file.write_text(series.model_dump_json(indent=2, exclude_none=True, exclude_unset=True))
+            series_list[f"{series.id}.json"] = series
             logger.debug(f"{series.id} - {series.title}")
 
+        with metrics.phase("write"):
+            await writer.write_models(series_list, exclude_none=True, exclude_unset=True)
+
+    with metrics.phase("finish"):
+        await writer.finish(prune=False)
+
     logger.info(f"fetched {total} series")
 
 
-def fetch_speakers(speakers_dir: Path) -> None:
-    speakers_dir.mkdir(parents=True, exist_ok=True)
+async def fetch_speakers(speakers_dir: Path, compact: bool) -> None:
+    writer: DataWriter = DataWriter(speakers_dir, compact=compact)
+    await writer.start()
 
     page: int = 0
     total: int = 0
     while page == 0 or len(results) > 0:
         page += 1
-        results = Node.get_speakers(
+        results = await call_node(
+            Node.get_speakers,
             broadcaster_id="phcc",
             params={"page": page},
-            page_size=100,
+            page_size=PAGE_SIZE,
         )
         # break if no results returned
         if len(results) == 0:
@@ -104,28 +214,56 @@ def fetch_speakers(speakers_dir: Path) -> None:
 
         # conver the results to series
         total += len(results)
+        speakers: dict[str, Speaker] = {}
         for result in results:
             speaker: Speaker = Speaker(**result._Model__obj)
-            speaker_file: Path = speakers_dir / f"{speaker.id}.json"
-            speaker_file.write_text(speaker.model_dump_json(indent=2, exclude_none=True, exclude_unset=True))
+            speakers[f"{speaker.id}.json"] = speaker
             logger.debug(f"{speaker.id} - {speaker.displayName}")
 
+        with metrics.phase("write"):
+            await writer.write_models(speakers, exclude_none=True, exclude_unset=True)
+
+    with metrics.phase("finish"):
+        await writer.finish(prune=False)
+
     logger.info(f"fetched {total} speakers")
 
 
-def main():
+async def main():
     args: Namespace = parse_args()
     data_dir: Path = Path(args.data_dir)
-    data_dir.mkdir(parents=True, exist_ok=True)
+    await data_dir.mkdir(parents=True, exist_ok=True)
 
     SERMONAUDIO_API_KEY: str = environ.get("SERMONAUDIO_API_KEY")
     set_api_key(SERMONAUDIO_API_KEY)
 
-    fetch_sermons(data_dir / "sermons", data_dir.parent / "assets" / "images" / "sermons")
-    fetch_series(data_dir / "series")
-    fetch_speakers(data_dir / "speakers")
+    # the SDK makes its own requests, so route its session through the cassette along with the thumbnail client
+    cassette: Optional[Cassette] = cassette_from_args(args)
+    if cassette is not None:
+        cassette.install(_session)
+
+    # the sermons, series and speakers are independent so fetch them all at the same time
+    async with create_client(cassette=cassette) as client:
+        async with create_task_group() as tg:
+            tg.start_soon(
+                fetch_sermons,
+                client,
+                data_dir / "sermons",
+                data_dir.parent / "assets" / "images" / "sermons",
+                BlobStore(data_dir.parent / "assets" / ".blobs"),
+                derivatives_from_args(args),
+                data_dir / ".sermons-sync.json",
+                timedelta(hours=args.full_reconcile_hours),
+                args.page_concurrency,
+                args.thumbnail_concurrency,
+                args.compact_json,
+            )
+            tg.start_soon(fetch_series, data_dir / "series", args.page_concurrency, args.compact_json)
+            tg.start_soon(fetch_speakers, data_dir / "speakers", args.compact_json)
+
+    metrics.report(args.metrics_file)
 
 
 if __name__ == "__main__":
     load_dotenv()
-    main()
+    run(main)
@@ -0,0 +1,55 @@
+import httpx
+import pytest
+
+from http_cassette import Cassette, CassetteTransport
+
+pytestmark = pytest.mark.anyio
+
+IMAGE: bytes = bytes(range(256)) * 16
+IMAGE_URL: str = "https://images.example.com/a.png"
+
+
+def image_server() -> tuple[httpx.MockTransport, list[httpx.Request]]:
+    """
+    Serve IMAGE, answering revalidations with 304 and ranges with 206.
+    """
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304, headers={"etag": '"v1"'})
+        if "range" in request.headers:
+            return httpx.Response(206, headers={"etag": '"v1"', "content-range": f"bytes 100-{len(IMAGE) - 1}/{len(IMAGE)}"}, content=IMAGE[100:])
+        return httpx.Response(200, headers={"etag": '"v1"'}, content=IMAGE)
+
+    return httpx.MockTransport(handler), requests
+
+
+async def get(cassette: Cassette, transport: httpx.AsyncBaseTransport, headers: dict[str, str]) -> httpx.Response:
+    async with httpx.AsyncClient(transport=CassetteTransport(cassette, transport)) as client:
+        return await client.get(IMAGE_URL, headers=headers)
+
+
+@pytest.mark.parametrize("headers", [{"If-None-Match": '"v1"'}, {"Range": "bytes=100-", "If-Range": '"v1"'}])
+async def test_records_conditional_requests_as_complete_responses(tmp_path, headers):
+    transport, requests = image_server()
+
+    response: httpx.Response = await get(Cassette(str(tmp_path), "record"), transport, headers)
+
+    assert response.status_code == 200
+    assert not {"if-none-match", "if-range", "range"} & requests[0].headers.keys()
+
+    response = await get(Cassette(str(tmp_path), "replay"), transport, {})
+    assert response.status_code == 200
+    assert response.content == IMAGE
+
+
+def test_partial_responses_keep_the_recorded_entry(tmp_path):
+    cassette: Cassette = Cassette(str(tmp_path), "record")
+    cassette.save("GET", IMAGE_URL, 200, [("etag", '"v1"')], IMAGE)
+
+    cassette.save("GET", IMAGE_URL, 304, [("etag", '"v1"')], b"")
+    cassette.save("GET", IMAGE_URL, 206, [("etag", '"v1"')], IMAGE[100:])
+
+    assert cassette.replay("GET", IMAGE_URL, {}) == (200, [("etag", '"v1"')], IMAGE)
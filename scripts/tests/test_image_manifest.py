@@ -0,0 +1,283 @@
+from os import utime
+from pathlib import Path
+from time import time
+from typing import Callable, Optional
+
+import anyio
+import httpx
+import pytest
+
+import image_manifest
+from image_manifest import BlobStore, ImageManifest, STALE_TEMP_SECONDS
+
+pytestmark = pytest.mark.anyio
+
+IMAGE: bytes = bytes(range(256)) * 64
+IMAGE_URL: str = "https://images.example.com/a.png"
+
+
+class CutStream(httpx.AsyncByteStream):
+    """
+    A response body that is cut off after its first third, like a connection that was reset.
+    """
+
+    def __init__(self, body: bytes):
+        self.body: bytes = body
+
+    async def __aiter__(self):
+        yield self.body[: len(self.body) // 3]
+        raise httpx.ReadError("connection reset")
+
+
+def image_server(
+    cuts: int = 0,
+    ranges: bool = True,
+    truncate: bool = False,
+    unsatisfiable: bool = False,
+    status: int = 200,
+) -> tuple[httpx.MockTransport, list[httpx.Request]]:
+    """
+    Serve IMAGE, cutting off the first responses. Ranges are honoured unless disabled, or answered with 416.
+    """
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if status != 200:
+            return httpx.Response(status)
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304)
+
+        range_header: Optional[str] = request.headers.get("range")
+        if range_header and unsatisfiable:
+            return httpx.Response(416)
+
+        offset: int = int(range_header[len("bytes=") : -1]) if range_header and ranges else 0
+        body: bytes = IMAGE[offset:]
+        headers: dict[str, str] = {"etag": '"v1"', "accept-ranges": "bytes" if ranges else "none", "content-length": str(len(body))}
+        if offset:
+            headers["content-range"] = f"bytes {offset}-{len(IMAGE) - 1}/{len(IMAGE)}"
+
+        if len(requests) <= cuts:
+            return httpx.Response(206 if offset else 200, headers=headers, stream=CutStream(body))
+        if truncate:
+            return httpx.Response(206 if offset else 200, headers=headers, stream=httpx.ByteStream(body[:-10]))
+        return httpx.Response(206 if offset else 200, headers=headers, content=body)
+
+    return httpx.MockTransport(handler), requests
+
+
+@pytest.fixture
+def store(tmp_path: Path) -> BlobStore:
+    return BlobStore(tmp_path / ".blobs")
+
+
+@pytest.fixture
+def manifest_factory(tmp_path: Path, store: BlobStore) -> Callable[[], ImageManifest]:
+    images_dir: Path = tmp_path / "images"
+    images_dir.mkdir()
+    return lambda: ImageManifest(images_dir, "events", store)
+
+
+async def download(transport: httpx.MockTransport, manifest: ImageManifest, name: str = "events-a.png") -> str:
+    async with httpx.AsyncClient(transport=transport) as client:
+        return await manifest.download(client, IMAGE_URL, anyio.Path(manifest.images_dir / name))
+
+
+def blobs(store: BlobStore) -> list[Path]:
+    return list(store.store_dir.glob("??/*"))
+
+
+async def test_resumes_interrupted_download(manifest_factory):
+    manifest: ImageManifest = manifest_factory()
+    transport, requests = image_server(cuts=2)
+
+    await download(transport, manifest)
+
+    assert (manifest.images_dir / "events-a.png").read_bytes() == IMAGE
+    assert requests[0].headers.get("range") is None
+    assert requests[1].headers["range"] == f"bytes={len(IMAGE) // 3}-"
+    assert requests[1].headers["if-range"] == '"v1"'
+    assert requests[2].headers["range"].startswith("bytes=")
+    assert manifest.entries[IMAGE_URL].size == len(IMAGE)
+
+
+async def test_restarts_when_server_ignores_ranges(manifest_factory):
+    manifest: ImageManifest = manifest_factory()
+    transport, requests = image_server(cuts=1, ranges=False)
+
+    await download(transport, manifest)
+
+    assert (manifest.images_dir / "events-a.png").read_bytes() == IMAGE
+    assert [r.headers.get("range") for r in requests] == [None, None]
+
+
+async def test_resumes_partial_download_from_last_run(manifest_factory, store):
+    partial = store.partial(IMAGE_URL)
+    partial.file.write_bytes(IMAGE[:1000])
+    partial.validator_file.write_text('"v1"')
+    transport, requests = image_server()
+
+    await download(transport, manifest_factory())
+
+    assert requests[0].headers["range"] == "bytes=1000-"
+    assert (store.store_dir.parent / "images" / "events-a.png").read_bytes() == IMAGE
+    assert not partial.file.exists()
+
+
+async def test_truncated_body_is_not_kept(manifest_factory, store):
+    manifest: ImageManifest = manifest_factory()
+    transport, _ = image_server(truncate=True)
+
+    with pytest.raises(httpx.RemoteProtocolError):
+        await download(transport, manifest)
+
+    assert not (manifest.images_dir / "events-a.png").exists()
+    assert IMAGE_URL not in manifest.entries
+    assert blobs(store) == []
+    # what was received is kept to resume from on the next run
+    assert store.partial(IMAGE_URL).offset == len(IMAGE) - 10
+
+
+async def test_starts_over_when_range_is_not_satisfiable(manifest_factory, store):
+    partial = store.partial(IMAGE_URL)
+    partial.file.write_bytes(IMAGE)
+    partial.validator_file.write_text('"v1"')
+    transport, requests = image_server(unsatisfiable=True)
+
+    await download(transport, manifest_factory())
+
+    assert [r.headers.get("range") for r in requests] == [f"bytes={len(IMAGE)}-", None]
+    assert (store.store_dir.parent / "images" / "events-a.png").read_bytes() == IMAGE
+
+
+async def test_gives_up_when_every_resume_is_not_satisfiable(manifest_factory, store):
+    manifest: ImageManifest = manifest_factory()
+    transport, _ = image_server(cuts=10, unsatisfiable=True)
+
+    with pytest.raises(httpx.RemoteProtocolError):
+        await download(transport, manifest)
+
+    assert not (manifest.images_dir / "events-a.png").exists()
+    assert blobs(store) == []
+
+
+async def test_not_modified_keeps_file(manifest_factory):
+    transport, requests = image_server()
+    manifest: ImageManifest = manifest_factory()
+    await download(transport, manifest)
+    manifest.save()
+
+    manifest = manifest_factory()
+    assert await download(transport, manifest) == "events-a.png"
+
+    assert requests[-1].headers["if-none-match"] == '"v1"'
+    assert manifest.used == {IMAGE_URL}
+
+
+async def test_missing_file_is_restored_from_the_store_and_revalidated(manifest_factory):
+    transport, requests = image_server()
+    manifest: ImageManifest = manifest_factory()
+    await download(transport, manifest)
+    manifest.save()
+    image_file: Path = manifest.images_dir / "events-a.png"
+    image_file.unlink()
+
+    manifest = manifest_factory()
+    assert manifest.cached(IMAGE_URL) is not None
+    assert not image_file.exists()
+
+    assert await download(transport, manifest) == "events-a.png"
+    assert requests[-1].headers["if-none-match"] == '"v1"'
+    assert image_file.read_bytes() == IMAGE
+
+
+async def test_failed_download_keeps_file_from_last_run(manifest_factory):
+    transport, _ = image_server()
+    manifest: ImageManifest = manifest_factory()
+    await download(transport, manifest)
+    manifest.save()
+
+    manifest = manifest_factory()
+    transport, _ = image_server(status=500)
+    with pytest.raises(httpx.HTTPStatusError) as e:
+        await download(transport, manifest)
+
+    assert manifest.failed(IMAGE_URL, e.value, anyio.Path(manifest.images_dir / "events-a.png")) == "events-a.png"
+    await manifest.prune("events-*.*")
+    assert (manifest.images_dir / "events-a.png").read_bytes() == IMAGE
+
+
+async def test_manifest_prune_keeps_files_of_this_run(manifest_factory):
+    transport, _ = image_server()
+    manifest: ImageManifest = manifest_factory()
+    await download(transport, manifest)
+    manifest.link(IMAGE_URL, anyio.Path(manifest.images_dir / "events-b.png"))
+    (manifest.images_dir / "events-old.png").write_bytes(b"old")
+
+    await manifest.prune("events-*.*")
+
+    assert sorted(p.name for p in manifest.images_dir.glob("events-*")) == ["events-a.png", "events-b.png"]
+
+
+async def test_manifest_prune_keeps_hidden_files(manifest_factory):
+    transport, _ = image_server()
+    manifest: ImageManifest = manifest_factory()
+    await download(transport, manifest)
+    manifest.save()
+    (manifest.images_dir / "old.png").write_bytes(b"old")
+
+    manifest = manifest_factory()
+    await download(transport, manifest)
+    await manifest.prune("*.*")
+
+    assert sorted(p.name for p in manifest.images_dir.iterdir()) == [".events-manifest.json", "events-a.png"]
+
+
+async def test_store_prune_keeps_copied_blobs_a_manifest_refers_to(manifest_factory, store, monkeypatch):
+    def cross_device_link(source, target):
+        raise OSError("cross-device link")
+
+    monkeypatch.setattr(image_manifest, "link", cross_device_link)
+    transport, _ = image_server()
+    manifest: ImageManifest = manifest_factory()
+    await download(transport, manifest)
+    manifest.save()
+
+    store.prune()
+    assert len(blobs(store)) == 1
+
+    # the next run no longer uses the image so both the site file and the blob go
+    manifest = manifest_factory()
+    await manifest.prune("events-*.*")
+    manifest.save()
+    store.prune()
+    assert blobs(store) == []
+
+
+def test_store_prune_keeps_linked_blobs(tmp_path, store):
+    temp_file: Path = Path(store.temp_file())
+    temp_file.write_bytes(IMAGE)
+    store.add(temp_file, "a" * 64)
+    store.link("a" * 64, tmp_path / "linked.png")
+
+    temp_file = Path(store.temp_file())
+    temp_file.write_bytes(b"unused")
+    store.add(temp_file, "b" * 64)
+
+    store.prune()
+
+    assert [blob.name for blob in blobs(store)] == ["a" * 64]
+
+
+def test_store_prune_removes_stale_temp_files(store):
+    stale: Path = store.temp_dir / "stale.part"
+    stale.write_bytes(b"old")
+    utime(stale, (time() - STALE_TEMP_SECONDS - 60,) * 2)
+    fresh: Path = store.temp_dir / "fresh.part"
+    fresh.write_bytes(b"new")
+
+    store.prune()
+
+    assert not stale.exists()
+    assert fresh.exists()
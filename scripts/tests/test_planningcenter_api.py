@@ -0,0 +1,141 @@
+import anyio
+import httpx
+import pytest
+from decorest.errors import HTTPErrorWrapper
+from pydantic import TypeAdapter, ValidationError
+
+from metrics import metrics
+import planningcenter_api
+from planningcenter_api import rate_limiter, retry_on_rate_limit, single_flight, RateLimiter
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeClock:
+    """
+    Stands in for the anyio clock so waiting for tokens takes no real time.
+    """
+
+    def __init__(self):
+        self.now: float = 0.0
+        self.sleeps: list[float] = []
+
+    def current_time(self) -> float:
+        return self.now
+
+    async def sleep(self, delay: float) -> None:
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+def http_error(status: int, headers: dict[str, str]) -> HTTPErrorWrapper:
+    request: httpx.Request = httpx.Request("GET", "https://api.planningcenteronline.com/calendar/v2/events")
+    response: httpx.Response = httpx.Response(status, headers=headers, request=request)
+    return HTTPErrorWrapper(httpx.HTTPStatusError("error", request=request, response=response))
+
+
+async def test_single_flight_shares_concurrent_calls():
+    calls: list[str] = []
+
+    @single_flight
+    async def lookup(key: str) -> str:
+        calls.append(key)
+        await anyio.sleep(0.01)
+        return key.upper()
+
+    results: list[str] = []
+
+    async def call(key: str) -> None:
+        results.append(await lookup(key))
+
+    async with anyio.create_task_group() as tg:
+        for key in ("a", "a", "b", "a"):
+            tg.start_soon(call, key)
+
+    assert sorted(calls) == ["a", "b"]
+    assert sorted(results) == ["A", "A", "A", "B"]
+    assert await lookup("a") == "A"
+    assert len(calls) == 2
+
+
+async def test_single_flight_retries_after_failure():
+    attempts: list[int] = []
+
+    @single_flight
+    async def lookup(key: str) -> str:
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("lookup failed")
+        return key
+
+    with pytest.raises(RuntimeError):
+        await lookup("a")
+
+    assert await lookup("a") == "a"
+    assert len(attempts) == 2
+
+
+async def test_rate_limiter_trusts_server_count():
+    limiter: RateLimiter = RateLimiter(limit=100, period=20.0)
+
+    limiter.update(httpx.Headers({"X-PCO-API-Request-Rate-Limit": "50", "X-PCO-API-Request-Rate-Period": "10", "X-PCO-API-Request-Rate-Count": "45"}))
+
+    assert limiter.limit == 50
+    assert limiter.period == 10.0
+    assert limiter.tokens == 5.0
+
+
+async def test_rate_limiter_waits_for_tokens(monkeypatch):
+    clock: FakeClock = FakeClock()
+    monkeypatch.setattr(planningcenter_api, "current_time", clock.current_time)
+    monkeypatch.setattr(planningcenter_api, "sleep", clock.sleep)
+    limiter: RateLimiter = RateLimiter(limit=2, period=20.0)
+
+    for _ in range(3):
+        await limiter.acquire()
+
+    # the third token refills at limit / period
+    assert clock.sleeps == [10.0]
+
+
+async def test_retry_on_rate_limit_retries_429(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "tokens", 100.0)
+    attempts: list[int] = []
+
+    class Client:
+        @retry_on_rate_limit
+        async def listing(self, **kwargs) -> str:
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise http_error(429, {"Retry-After": "0"})
+            return "page"
+
+    assert await Client().listing() == "page"
+    assert len(attempts) == 2
+    assert metrics.endpoints["Client.listing"].rate_limited == 1
+
+
+async def test_retry_on_rate_limit_raises_other_errors_unchanged(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "tokens", 100.0)
+
+    class Client:
+        @retry_on_rate_limit
+        async def missing(self, **kwargs) -> None:
+            raise http_error(404, {})
+
+        @retry_on_rate_limit
+        async def invalid(self, **kwargs) -> None:
+            TypeAdapter(int).validate_python("not a number")
+
+        @retry_on_rate_limit
+        async def unreachable(self, **kwargs) -> None:
+            raise httpx.ConnectError("connection refused")
+
+    with pytest.raises(HTTPErrorWrapper):
+        await Client().missing()
+    with pytest.raises(ValidationError):
+        await Client().invalid()
+    with pytest.raises(httpx.ConnectError):
+        await Client().unreachable()
+
+    assert [metrics.endpoints[f"Client.{name}"].errors for name in ("missing", "invalid", "unreachable")] == [1, 1, 1]
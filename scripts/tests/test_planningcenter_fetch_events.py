@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta, UTC
+from itertools import permutations
+from types import SimpleNamespace
+
+from anyio import Path
+import pytest
+
+from planningcenter_fetch_events import EventSync
+
+pytestmark = pytest.mark.anyio
+
+UPDATED_AT: datetime = datetime(2026, 1, 1, tzinfo=UTC)
+
+
+def instance(instance_id: str, starts_at: datetime, updated_at: datetime = UPDATED_AT) -> SimpleNamespace:
+    return SimpleNamespace(id=instance_id, starts_at=starts_at, event=SimpleNamespace(id="event", updated_at=updated_at))
+
+
+async def test_record_keeps_latest_instance_in_any_order(tmp_path):
+    start: datetime = datetime(2026, 2, 1, tzinfo=UTC)
+    instances: list[SimpleNamespace] = [instance("3", start), instance("1", start + timedelta(weeks=1)), instance("2", start + timedelta(weeks=1))]
+
+    for order in permutations(instances):
+        sync: EventSync = EventSync(Path(tmp_path / ".events-sync.json"), timedelta(hours=24))
+        for i in order:
+            sync.record(i)
+
+        assert sync.synced["event"].instance_id == "2"
+
+
+async def test_unchanged_events_reuse_stored_enrichment(tmp_path):
+    events_dir: Path = Path(tmp_path / "events")
+    await events_dir.mkdir()
+    await (events_dir / "1.json").write_text('{"group_tags": {"ministry": "youth"}}')
+    state_file: Path = Path(tmp_path / ".events-sync.json")
+
+    sync: EventSync = EventSync(state_file, timedelta(hours=24))
+    await sync.load(events_dir)
+    assert sync.is_full_refresh
+    sync.record(instance("1", datetime(2026, 2, 1, tzinfo=UTC)))
+    await sync.save()
+
+    sync = EventSync(state_file, timedelta(hours=24))
+    await sync.load(events_dir)
+    assert not sync.is_full_refresh
+    assert sync.enrichment(SimpleNamespace(id="event", updated_at=UPDATED_AT)).group_tags == {"ministry": "youth"}
+    assert sync.enrichment(SimpleNamespace(id="event", updated_at=UPDATED_AT + timedelta(minutes=1))) is None
@@ -0,0 +1,95 @@
+from anyio import CapacityLimiter, Path
+import httpx
+import pytest
+
+import planningcenter_fetch_ministries
+from image_manifest import BlobStore, ImageManifest
+from planningcenter_fetch_ministries import download_image, image_sources, md, MarkdownCache, MarkdownCacheState
+
+pytestmark = pytest.mark.anyio
+
+HTML: str = '<p>Join us for <a href="https://example.com/signup">sign up</a> today.</p>'
+
+
+def test_links_open_in_new_tab():
+    assert md(HTML).strip() == 'Join us for <a href="https://example.com/signup" target="_blank">sign up</a> today.'
+
+
+def test_links_keep_surrounding_whitespace():
+    assert md('<p>a<a href="https://example.com"> padded </a>b</p>').strip() == 'a <a href="https://example.com" target="_blank">padded</a> b'
+
+
+def test_links_without_href_are_text():
+    assert md("<p><a>plain</a></p>").strip() == "plain"
+
+
+@pytest.fixture
+def converted(monkeypatch) -> list[str]:
+    calls: list[str] = []
+    convert = planningcenter_fetch_ministries.md
+
+    def counting_md(html: str) -> str:
+        calls.append(html)
+        return convert(html)
+
+    monkeypatch.setattr(planningcenter_fetch_ministries, "md", counting_md)
+    return calls
+
+
+async def test_unchanged_blocks_are_not_converted_again(tmp_path, converted):
+    cache_file: Path = Path(tmp_path / ".ministries-markdown.json")
+
+    cache: MarkdownCache = MarkdownCache(cache_file)
+    await cache.load()
+    markdown: str = cache.convert(HTML)
+    await cache.save()
+
+    cache = MarkdownCache(cache_file)
+    await cache.load()
+    assert cache.convert(HTML) == markdown
+    assert cache.hits == 1
+    assert converted == [HTML]
+
+
+async def test_cache_of_other_converter_version_is_dropped(tmp_path, converted):
+    cache_file: Path = Path(tmp_path / ".ministries-markdown.json")
+    await cache_file.write_text(MarkdownCacheState(version="0-markdownify-0.0.0", blocks={"stale": "markdown"}).model_dump_json())
+
+    cache: MarkdownCache = MarkdownCache(cache_file)
+    await cache.load()
+
+    assert cache.blocks == {}
+
+
+async def test_blocks_not_seen_are_dropped_on_save(tmp_path, converted):
+    cache_file: Path = Path(tmp_path / ".ministries-markdown.json")
+
+    cache: MarkdownCache = MarkdownCache(cache_file)
+    cache.convert(HTML)
+    cache.convert("<p>removed</p>")
+    await cache.save()
+
+    cache = MarkdownCache(cache_file)
+    await cache.load()
+    cache.convert(HTML)
+    await cache.save()
+
+    state: MarkdownCacheState = MarkdownCacheState.model_validate_json(await cache_file.read_text())
+    assert list(state.blocks.values()) == [md(HTML)]
+
+
+async def test_image_without_file_is_linked_from_planning_center(tmp_path):
+    images_dir: Path = Path(tmp_path / "images")
+    await images_dir.mkdir()
+    manifest: ImageManifest = ImageManifest(images_dir, "ministry", BlobStore(tmp_path / ".blobs"))
+    url: str = "https://images.example.com/missing.png"
+    image_files: list[Path] = [images_dir / "ministry-youth-1.png", images_dir / "ministry-youth-2.png"]
+    missing: dict[str, str] = {}
+
+    transport: httpx.MockTransport = httpx.MockTransport(lambda request: httpx.Response(404))
+    async with httpx.AsyncClient(transport=transport) as client:
+        await download_image(client, manifest, CapacityLimiter(1), url, image_files, missing)
+
+    assert not any([await image_file.exists() for image_file in image_files])
+    sources: dict[str, str] = image_sources({"1": "ministry-youth-1.png", "2": "ministry-youth-2.png", "3": "ministry-youth-3.png"}, missing)
+    assert sources == {"1": url, "2": url, "3": "~/assets/images/ministry-youth-3.png"}